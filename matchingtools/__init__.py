@@ -21,6 +21,8 @@ from matchingtools.core import (
     sigma4,
     boson,
     fermion,
+    SubstitutionCache,
+    set_eager_normalization,
 )
 from matchingtools.integration import (
     RealScalar,
@@ -30,6 +32,7 @@ from matchingtools.integration import (
     VectorLikeFermion,
     MajoranaFermion,
     integrate,
+    IntegrationSession,
 )
 from matchingtools.transformations import (
     collect_numbers,
@@ -37,6 +40,7 @@ from matchingtools.transformations import (
     collect_numbers_and_powers,
     apply_rule,
     apply_rules,
+    integrate_by_parts,
     collect_by_tensors,
     collect,
 )
@@ -66,6 +70,8 @@ __all__ = [
     "sigma4",
     "boson",
     "fermion",
+    "SubstitutionCache",
+    "set_eager_normalization",
     "RealScalar",
     "ComplexScalar",
     "RealVector",
@@ -73,11 +79,13 @@ __all__ = [
     "VectorLikeFermion",
     "MajoranaFermion",
     "integrate",
+    "IntegrationSession",
     "collect_numbers",
     "collect_powers",
     "collect_numbers_and_powers",
     "apply_rule",
     "apply_rules",
+    "integrate_by_parts",
     "collect_by_tensors",
     "collect",
     "Writer",
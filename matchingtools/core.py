@@ -16,9 +16,37 @@ Defines the Lorentz tensors :data:`epsUp`, :data:`epsUpDot`,
 :data:`sigma4bar`.
 """
 
-from matchingtools.permutations import permutations
+from collections import OrderedDict
 
-from matchingtools.lsttools import concat, enum_product
+from matchingtools.permutations import reordering_sign
+
+from matchingtools.lsttools import concat
+
+_eager_normalization = False
+
+def set_eager_normalization(enabled=True):
+    """
+    Enable or disable the eager normalization mode.
+
+    In this mode, the numbers and the powers of the tensors of each
+    operator are collected (see :func:`normalize`) when it is created
+    by :meth:`Operator.__mul__`, :meth:`Operator.replace_at_position`
+    or the application of a rule, instead of only at the end, in
+    ``matchingtools.transformations.collect`` and
+    ``matchingtools.transformations.simplify``. This keeps the operators
+    short during the computations, but patterns containing separate
+    numbers or powers of the same tensor won't match anymore.
+
+    The mode is global and is passed to the worker processes of
+    ``matchingtools.integration.integrate`` and
+    ``matchingtools.transformations.apply_rules``.
+    """
+    global _eager_normalization
+    _eager_normalization = enabled
+
+def eager_normalization():
+    """Return whether the eager normalization mode is enabled"""
+    return _eager_normalization
 
 class Tensor(object):
     """
@@ -28,10 +56,16 @@ class Tensor(object):
     indices correponding to the derivatives are given by the first
     indices in the list of indices of the Tensor.
 
+    Tensors are immutable: they use ``__slots__``, store their indices
+    as a tuple and precompute their hash, so that the same object can
+    be safely shared by any number of operators. Any iterable of
+    indices (in particular a list) is accepted by the constructor and
+    converted to a tuple.
+
     Attributes:
         name (string): identifier
-        indices (list of ints): indices of the tensor and the
-                                derivaties applied to it
+        indices (tuple of ints): indices of the tensor and the
+                                 derivaties applied to it
         is_field (bool): specifies whether it is non-constant
         num_of_der (int): number of derivatives acting
         dimension (int): energy dimensions
@@ -39,19 +73,45 @@ class Tensor(object):
         content: to be used internally to carry associated data
         exponent: to be used internally to simplify repetitions of a tensor
     """
+
+    __slots__ = ("name", "indices", "is_field", "num_of_der", "dimension",
+                 "statistics", "content", "exponent", "_hash")
     
     def __init__(self, name, indices, is_field=False, num_of_der=0,
                  dimension=0, statistics=True, content=None, exponent=None):
-        self.name = name
-        self.indices = indices
-        self.is_field = is_field
-        self.num_of_der = num_of_der
-        self.dimension = dimension
-        self.statistics = statistics
-        self.content = content
-        self.exponent = exponent
-        if self.name == "$number" and self.content is None:
+        if name == "$number" and content is None:
             raise Exception()
+        indices = tuple(indices)
+        if isinstance(content, list):
+            content = tuple(content)
+        init = object.__setattr__
+        init(self, "name", name)
+        init(self, "indices", indices)
+        init(self, "is_field", is_field)
+        init(self, "num_of_der", num_of_der)
+        init(self, "dimension", dimension)
+        init(self, "statistics", statistics)
+        init(self, "content", content)
+        init(self, "exponent", exponent)
+        init(self, "_hash", hash((name, indices, num_of_der,
+                                  content, exponent)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Tensor objects are immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("Tensor objects are immutable")
+
+    def __reduce__(self):
+        return (Tensor, (self.name, self.indices, self.is_field,
+                         self.num_of_der, self.dimension, self.statistics,
+                         self.content, self.exponent))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
         
     def __str__(self):
         """
@@ -93,8 +153,16 @@ class Tensor(object):
 
     # __repr__ = __str__
 
+    def __hash__(self):
+        return self._hash
+
     def __eq__(self, other):
-        return (self.name == other.name and
+        if self is other:
+            return True
+        if not isinstance(other, Tensor):
+            return NotImplemented
+        return (self._hash == other._hash and
+                self.name == other.name and
                 self.indices == other.indices and
                 self.is_field == other.is_field and
                 self.num_of_der == other.num_of_der and
@@ -103,6 +171,12 @@ class Tensor(object):
                 self.content == other.content and
                 self.exponent == other.exponent)
 
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
     @property
     def der_indices(self):
         return self.indices[:self.num_of_der]
@@ -120,6 +194,15 @@ class Tensor(object):
                       content=self.content,
                       exponent=self.exponent)
 
+    def change_name(self, new_name):
+        return Tensor(new_name, self.indices,
+                      is_field=self.is_field,
+                      num_of_der=self.num_of_der,
+                      dimension=self.dimension,
+                      statistics=self.statistics,
+                      content=self.content,
+                      exponent=self.exponent)
+
 class Operator(object):
     """
     Container for a list of tensors with their indices contracted.
@@ -131,12 +214,27 @@ class Operator(object):
     The methods include the basic derivation, matching and replacing 
     operations, as well as the implementation of functional derivatives.
 
+    Operators use ``__slots__``, so that the caches of the many
+    intermediate operators built during a calculation take little
+    memory. The caches are not pickled.
+
     Attributes:
         tensors ([Tensor]): list of the tensors contained
     """
+
+    __slots__ = ("tensors", "_canonical_form", "_symmetries", "_positions",
+                 "_dimension", "_orders")
     
     def __init__(self, tensors):
         self.tensors = tensors
+        self._canonical_form = None
+        self._symmetries = None
+        self._positions = None
+        self._dimension = None
+        self._orders = None
+
+    def __reduce__(self):
+        return (Operator, (self.tensors,))
 
     def __str__(self):
         return " ".join(map(str, self.tensors))
@@ -144,6 +242,8 @@ class Operator(object):
     # __repr__ = __str__
 
     def __mul__(self, other):
+        if _eager_normalization:
+            return normalize(Operator(self.tensors + other.tensors))
         return Operator(self.tensors + other.tensors)
 
     def __neg__(self):
@@ -151,8 +251,10 @@ class Operator(object):
     
     @property
     def dimension(self):
-        return sum([tensor.dimension + tensor.num_of_der
-                    for tensor in self.tensors])
+        if self._dimension is None:
+            self._dimension = sum([tensor.dimension + tensor.num_of_der
+                                   for tensor in self.tensors])
+        return self._dimension
 
     @property
     def max_index(self):
@@ -164,6 +266,23 @@ class Operator(object):
     def contains(self, name):
         return any(tensor.name == name for tensor in self.tensors)
 
+    def inverse_mass_order(self, masses):
+        """
+        Compute (and cache) the order of the operator in the inverse of
+        the given masses: minus the sum of the exponents of the tensors
+        representing them (see :func:`inverse_mass_order`).
+
+        Args:
+            masses (frozenset of strings): names of the mass tensors
+        """
+        if self._orders is None:
+            self._orders = {}
+        order = self._orders.get(masses)
+        if order is None:
+            order = inverse_mass_order(self.tensors, masses)
+            self._orders[masses] = order
+        return order
+
     def derivative(self, index):
         return leibniz_rule(index, self)
                 
@@ -191,30 +310,39 @@ class Operator(object):
                                  which the functional derivative is taken
             statistics (bool): statistics of the field
         """
-        result = OperatorSum()
-        for pos, tensor in enumerate(self.tensors):
-            if tensor.name == field_name:
-                inside_op = self.remove_tensor(pos)
-                der_inds = remove_indices(tensor.der_indices,
-                                          tensor.non_der_indices)
-                
-                # Compute the sign taking into account the number of
-                # derivatives that act on the field and the number of
-                # fermions before it in the fermionic case
-                minus_sign = len(der_inds) % 2 == 1
-
-                if statistics == fermion:
-                    number_of_fermions = len([1 for t in self.tensors[:pos]
-                                              if not t.statistics])
-                    minus_sign = minus_sign != (number_of_fermions % 2 == 1)
-                if minus_sign:
-                    inside_op *= number_op(-1)
-
-                # Apply the derivatives with the correponding indices
-                inside_ops = OperatorSum([inside_op])
-                result += apply_derivatives(list(reversed(der_inds)),
-                                            inside_ops)
-        return result
+        return OperatorSum(concat([
+            self.variation_at(pos, statistics).operators
+            for pos in self.positions().get(field_name, [])]))
+
+    def variation_at(self, pos, statistics):
+        """
+        Take the part of the functional derivative of the spacetime
+        integral of self that comes from the field at a given position.
+
+        Args:
+            pos (int): position of the field
+            statistics (bool): statistics of the field
+        """
+        tensor = self.tensors[pos]
+        inside_op = self.remove_tensor(pos)
+        der_inds = remove_indices(tensor.der_indices,
+                                  tensor.non_der_indices)
+
+        # Compute the sign taking into account the number of
+        # derivatives that act on the field and the number of
+        # fermions before it in the fermionic case
+        minus_sign = len(der_inds) % 2 == 1
+
+        if statistics == fermion:
+            number_of_fermions = len([1 for t in self.tensors[:pos]
+                                      if not t.statistics])
+            minus_sign = minus_sign != (number_of_fermions % 2 == 1)
+        if minus_sign:
+            inside_op *= number_op(-1)
+
+        # Apply the derivatives with the correponding indices
+        inside_ops = OperatorSum([inside_op])
+        return apply_derivatives(list(reversed(der_inds)), inside_ops)
 
     def prepare_indices(self, incr, free_indices):
         """
@@ -243,16 +371,30 @@ class Operator(object):
         # Insert in the corresponding position
         tens_left = self.tensors[:position]
         tens_right = self.tensors[position+1:]
+        if _eager_normalization:
+            return OperatorSum([
+                normalize(Operator(tens_left + op.tensors + tens_right))
+                for op in der_subs_ops.operators])
         return OperatorSum([Operator(tens_left + op.tensors + tens_right)
                             for op in der_subs_ops.operators])
 
-    def replace_first(self, field_name, operator_sum):
+    def replace_first(self, field_name, operator_sum, max_dim=None,
+                      cache=None, max_order=None, masses=None):
         """
         Replace the first ocurrence of a field.
 
         Args:
             field_name (string): name of the field to be replaced
             operator_sum (OperatorSum): replacement
+            max_dim (int): if given, the terms of the replacement that
+                would give operators of higher dimension are skipped
+            cache (SubstitutionCache): if given, results are looked up
+                in it and stored in it (see :class:`SubstitutionCache`)
+            max_order (int): if given, the terms of the replacement that
+                would give operators of higher order in the inverse of
+                the masses are skipped
+            masses (frozenset of strings): names of the mass tensors,
+                required when ``max_order`` is given
 
         Return:
             An OperatorSum resulting from replacing the first ocurrence of
@@ -260,11 +402,54 @@ class Operator(object):
         """
         for pos, tensor in enumerate(self.tensors):
             if tensor.name == field_name:
-                return sum([self.replace_at_position(pos, op)
-                            for op in operator_sum.operators],
-                           OperatorSum())
+                break
+        else:
+            return None
+
+        if cache is not None:
+            key, sign, order = self.canonical_form()
+            if sign != 0:
+                # The tensor at pos is at canonical_pos in the canonical
+                # operator, whatever the position of its first ocurrence
+                canonical_pos = order.index(pos)
+                cache_key = ("replace_first", key, canonical_pos, field_name,
+                             id(operator_sum), max_dim, max_order, masses)
+                operators = cache.lookup(cache_key, operator_sum)
+                if operators is None:
+                    operators = self.canonical_operator()._replace_up_to(
+                        canonical_pos, operator_sum, max_dim,
+                        max_order, masses).operators
+                    cache.store(cache_key, operator_sum, operators)
+                return self.from_canonical(operators)
+
+        return self._replace_up_to(pos, operator_sum, max_dim,
+                                   max_order, masses)
+
+    def _replace_up_to(self, pos, operator_sum, max_dim, max_order, masses):
+        """
+        Replace the tensor at the given position by each term of the
+        operator sum whose result wouldn't exceed ``max_dim`` and
+        ``max_order`` (see :meth:`replace_first`).
+        """
+        tensor = self.tensors[pos]
+        if max_dim is not None or max_order is not None:
+            # The derivatives acting on the field are kept
+            operators = operator_sum.terms_up_to(
+                None if max_dim is None else
+                max_dim - self.dimension + tensor.dimension,
+                None if max_order is None else
+                max_order - self.inverse_mass_order(masses) +
+                inverse_mass_order([tensor], masses),
+                masses)
+        else:
+            operators = operator_sum.operators
+        result = []
+        for op in operators:
+            result += self.replace_at_position(pos, op).operators
+        return OperatorSum(result)
 
-    def replace_all(self, substitutions, max_dim):
+    def replace_all(self, substitutions, max_dim, cache=None,
+                    max_order=None, masses=None):
         """
         Replace all ocurrences of several fields.
 
@@ -274,45 +459,169 @@ class Operator(object):
                 name of a field to be replaced and the second being the
                 replacement.
             max_dim (int): maximum dimension of the operators in the result
+            cache (SubstitutionCache): if given, results are looked up
+                in it and stored in it (see :class:`SubstitutionCache`)
+            max_order (int): if given, maximum order in the inverse of
+                the masses of the operators in the result
+            masses (frozenset of strings): names of the mass tensors,
+                required when ``max_order`` is given
 
         Return:
             An OperatorSum resulting from replacing every ocurrence of the
             fields by their replacements
         """
+        if cache is not None:
+            key, sign, _ = self.canonical_form()
+            if sign != 0:
+                cache_key = ("replace_all", key, id(substitutions), max_dim,
+                             max_order, masses)
+                operators = cache.lookup(cache_key, substitutions)
+                if operators is None:
+                    operators = self.canonical_operator().replace_all(
+                        substitutions, max_dim, max_order=max_order,
+                        masses=masses).operators
+                    cache.store(cache_key, substitutions, operators)
+                return self.from_canonical(operators)
+
         for field_name, subs in substitutions.items():
-            new_ops = self.replace_first(field_name, subs)
+            new_ops = self.replace_first(field_name, subs, max_dim,
+                                         max_order=max_order, masses=masses)
             if new_ops is not None:
-                return new_ops.replace_all(substitutions, max_dim)
+                return new_ops.replace_all(substitutions, max_dim,
+                                           max_order=max_order, masses=masses)
         return OperatorSum()
 
+    def canonical_operator(self):
+        """
+        Return an operator with the tensors of self in canonical order and
+        the contracted indices relabelled as 0, 1, 2... by order of
+        appearance (see :meth:`canonical_form`).
+
+        When the sign of the canonical form is not 0, the operator is
+        equal to self times the sign.
+        """
+        _, _, order = self.canonical_form()
+        labels = {}
+        tensors = []
+        for pos in order:
+            tensor = self.tensors[pos]
+            tensors.append(tensor.change_indices(
+                [labels.setdefault(index, len(labels)) if index >= 0
+                 else index for index in tensor.indices]))
+        return Operator(tensors)
+
+    def from_canonical(self, operators):
+        """
+        Translate operators obtained from :meth:`canonical_operator` to
+        the indices of self, multiplying them by the sign of the
+        canonical form.
+
+        Contracted indices not present in the canonical operator are
+        given new values, greater than all the indices of self.
+        """
+        _, sign, order = self.canonical_form()
+        indices = []
+        seen = set()
+        for pos in order:
+            for index in self.tensors[pos].indices:
+                if index >= 0 and index not in seen:
+                    seen.add(index)
+                    indices.append(index)
+        num_of_labels = len(indices)
+        incr = max(self.max_index + 1, 0) - num_of_labels
+        extra = [number_op(-1).tensors[0]] if sign == -1 else []
+        if indices == list(range(num_of_labels)) and incr == 0:
+            return OperatorSum([Operator(operator.tensors + extra)
+                                for operator in operators])
+        result = []
+        for operator in operators:
+            tensors = [
+                tensor.change_indices(
+                    [index if index < 0 else
+                     indices[index] if index < num_of_labels else
+                     index + incr for index in tensor.indices])
+                if tensor.indices else tensor
+                for tensor in operator.tensors]
+            result.append(Operator(tensors + extra))
+        return OperatorSum(result)
+
     def match_first(self, pattern):
         """
         Match the first ocurrence of a pattern
 
         Args:
-            pattern (``Operator``): contains the tensors and index structure
-                to be matched
+            pattern (``Operator`` or ``Pattern``): contains the tensors and
+                index structure to be matched
 
         Return:
             if the matching succeeds, an Operator with the first occurrence
                 of the pattern substituted by a "generic" tensor (with a sign 
                 change if needed); None otherwise
         """
-        fermions = tuple(pos for pos, tensor in enumerate(self.tensors)
-                         if tensor.statistics == fermion)
-        for match in match_tensor_lists(self.tensors, pattern.tensors):
-            candidate = [self.tensors[pos] for pos in match]
-            matches, free_indices = match_indices(candidate, pattern.tensors)
-            if matches:
-                # Compute change of sign due to fermion permutation
-                fermion_reorder = tuple(fermions.index(pos)
-                                        for pos in match if pos in fermions)
-                sign = permutations(len(fermions))[fermion_reorder]
-                if sign == -1: candidate.append(number_op(-1).tensors[0])
-
-                # Replace the matched part by a "generic" tensor
-                return Operator([generic(*free_indices)] +
-                                candidate[len(pattern.tensors):])
+        if not isinstance(pattern, Pattern):
+            pattern = Pattern(pattern)
+        matches = match_tensor_lists(self.tensors, pattern,
+                                     self.symmetries, self.positions())
+        for match, free_indices in matches:
+            rest = [self.tensors[pos] for pos in match[len(pattern):]]
+
+            # Compute change of sign due to fermion permutation
+            sign = self.fermion_sign(match, pattern)
+            if sign == -1: rest.append(number_op(-1).tensors[0])
+
+            # Replace the matched part by a "generic" tensor
+            return Operator([generic(*free_indices)] + rest)
+
+    def fermion_sign(self, match, pattern):
+        """
+        Sign due to the reordering of the fermions of the operator
+        given by a match of a (compiled) pattern.
+        """
+        fermions = [match[pos] for pos in pattern.fermions]
+        fermions += [pos for pos in match[len(pattern):]
+                     if self.tensors[pos].statistics == fermion]
+        return reordering_sign(fermions)
+
+    def canonical_form(self):
+        """
+        Compute (and cache) the canonical form of the operator.
+
+        The operator shouldn't be modified after calling this method.
+
+        Return:
+            A triple ``(key, sign, order)`` as described in
+            :func:`canonical_form`.
+        """
+        if self._canonical_form is None:
+            self._canonical_form = canonical_form(self.tensors)
+        return self._canonical_form
+
+    def positions(self):
+        """
+        Compute (and cache) a dictionary with the names of the tensors
+        of the operator as keys and the lists of their positions as values.
+
+        The operator shouldn't be modified after calling this method.
+        """
+        if self._positions is None:
+            self._positions = {}
+            for pos, tensor in enumerate(self.tensors):
+                self._positions.setdefault(tensor.name, []).append(pos)
+        return self._positions
+
+    def symmetries(self):
+        """
+        Compute (and cache) the interchangeable tensors of the operator,
+        as given by :func:`tensor_symmetries`.
+
+        The operator shouldn't be modified after calling this method.
+        """
+        if self._symmetries is None:
+            self._symmetries = tensor_symmetries(self.tensors)
+        return self._symmetries
+
+    def __hash__(self):
+        return hash(self.canonical_form()[0])
 
     def __eq__(self, other):
         """
@@ -322,27 +631,12 @@ class Operator(object):
         """
         if len(self.tensors) != len(other.tensors):
             return False
-        fermions = tuple(pos for pos, tensor in enumerate(self.tensors)
-                         if tensor.statistics == fermion)
-        for match in match_tensor_lists(self.tensors, other.tensors):
-            candidate = [self.tensors[pos] for pos in match]
-            matches, free_indices = match_indices(candidate, other.tensors)
-            if matches:
-                # If there has been an odd permutation of fermions,
-                # equality fails
-                fermion_reorder = tuple(fermions.index(pos)
-                                        for pos in match if pos in fermions)
-                sign = permutations(len(fermions))[fermion_reorder]
-                if sign == -1: return False
-
-                # Checking that all free indices are equal
-                same_free_indices = True
-                for i, index in enumerate(free_indices):
-                    if i != -1 - index:
-                        same_free_indices = False
-                if same_free_indices:
-                    return True
-        return False
+        key, sign, _ = self.canonical_form()
+        other_key, other_sign, _ = other.canonical_form()
+        return key == other_key and (sign == other_sign or sign == 0)
+
+    def __ne__(self, other):
+        return not self == other
 
 class OperatorSum(object):
     """
@@ -358,6 +652,8 @@ class OperatorSum(object):
         if operators is None:
             operators = []
         self.operators = operators
+        self._terms_up_to = {}
+        self._field_index = None
 
     def __str__(self):
         return " + ".join(map(str, self.operators))
@@ -375,6 +671,47 @@ class OperatorSum(object):
     def __neg__(self):
         return OperatorSum([-op for op in self.operators])
 
+    def terms_up_to(self, max_dim, max_order=None, masses=None):
+        """
+        Compute (and cache) the list of the operators of the sum whose
+        dimension is not greater than max_dim, keeping their order.
+
+        If ``max_order`` is given, only the operators whose order in the
+        inverse of the ``masses`` is not greater than it are kept. Any of
+        the bounds can be None.
+
+        The sum shouldn't be modified after calling this method.
+        """
+        key = (max_dim, max_order, masses)
+        terms = self._terms_up_to.get(key)
+        if terms is None:
+            terms = [op for op in self.operators
+                     if (max_dim is None or op.dimension <= max_dim) and
+                     (max_order is None or
+                      op.inverse_mass_order(masses) <= max_order)]
+            self._terms_up_to[key] = terms
+        return terms
+
+    def field_index(self):
+        """
+        Compute (and cache) a dictionary with the names of the tensors
+        in the sum as keys and, as values, the lists of pairs
+        ``(number, position)`` of the number of each operator in which
+        they appear and their position inside it.
+
+        The sum shouldn't be modified after calling this method.
+        """
+        if self._field_index is None:
+            self._field_index = {}
+            for number, operator in enumerate(self.operators):
+                for pos, tensor in enumerate(operator.tensors):
+                    self._field_index.setdefault(tensor.name, []).append(
+                        (number, pos))
+        return self._field_index
+
+    def contains(self, name):
+        return name in self.field_index()
+
     def derivative(self, index):
         """Takes the derivative with the given index"""
         return OperatorSum(concat([op.derivative(index).operators
@@ -384,16 +721,41 @@ class OperatorSum(object):
         """
         Take functional derivative of the spacetime integral of self.
 
+        Only the operators where the field appears are visited
+        (see :meth:`field_index`).
+
         Args:
             field_name (string): the name of the field with respect to
                                  which the functional derivative is taken
             statistics (bool): statistics of the field
         """
-        return sum([op.variation(field_name, statistics)
-                    for op in self.operators],
-                   OperatorSum())
+        return self.variations([(field_name, statistics)])[field_name]
+
+    def variations(self, names_with_statistics):
+        """
+        Take the functional derivatives of the spacetime integral of
+        self with respect to several fields.
+
+        The operators where the fields appear are found at once with
+        :meth:`field_index`, which is computed only once for the sum.
+
+        Args:
+            names_with_statistics ([(string, bool)]): pairs with the name
+                of each field and its statistics
+
+        Return:
+            A dict with the OperatorSum of the functional derivative
+            with respect to each field
+        """
+        index = self.field_index()
+        return dict(
+            (field_name, OperatorSum(concat([
+                self.operators[number].variation_at(pos, statistics).operators
+                for number, pos in index.get(field_name, [])])))
+            for field_name, statistics in names_with_statistics)
     
-    def replace_all(self, substitutions, max_dim):
+    def replace_all(self, substitutions, max_dim, cache=None,
+                    max_order=None, masses=None):
         """
         Replace all ocurrences of several fields.
 
@@ -403,26 +765,207 @@ class OperatorSum(object):
                 name of a field to be replaced and the second being the
                 replacement.
             max_dim (int): maximum dimension of the operators in the result
+            cache (SubstitutionCache): if given, the results for each
+                operator are looked up in it and stored in it (see
+                :meth:`Operator.replace_all`)
+            max_order (int): if given, maximum order in the inverse of
+                the masses of the operators in the result. Operators of
+                higher order are dropped as soon as they are produced,
+                so the replacements shouldn't contain positive powers of
+                the masses.
+            masses (frozenset of strings): names of the mass tensors,
+                required when ``max_order`` is given
 
         Return:
             An OperatorSum resulting from replacing every ocurrence of the
             fields by their replacements
+
+        The operators are processed one by one from a worklist: the
+        ones produced by a replacement are processed right after,
+        and those that need no more replacements go straight to
+        the result, keeping the order of the sum. The operators of
+        the sum where none of the fields appear (see :meth:`field_index`)
+        skip the worklist.
         """
-        field_names = substitutions.keys()
-        changed = False
+        field_names = list(substitutions.keys())
+        index = self.field_index()
+        touched = set(number for name in field_names
+                      for number, _ in index.get(name, []))
         result = []
-        for operator in self.operators:
-            if (operator.dimension <= max_dim and
-                not any(operator.contains(name) for name in field_names)):
-                result.append(operator)
-            elif operator.dimension < max_dim:
-                changed = True
-                result += operator.replace_all(substitutions,
-                                               max_dim).operators
-        if changed:
-            return OperatorSum(result).replace_all(substitutions, max_dim)
+        for number, operator in enumerate(self.operators):
+            if number not in touched:
+                if (operator.dimension <= max_dim and
+                    (max_order is None or
+                     operator.inverse_mass_order(masses) <= max_order)):
+                    result.append(operator)
+                continue
+            # Operators still to be processed, the next one at the end
+            pending = [operator]
+            while pending:
+                operator = pending.pop()
+                if (max_order is not None and
+                    operator.inverse_mass_order(masses) > max_order):
+                    continue
+                dimension = operator.dimension
+                names = operator.positions()
+                present = [name for name in field_names if name in names]
+                if dimension <= max_dim and not present:
+                    result.append(operator)
+                elif dimension < max_dim and cache is not None:
+                    result += operator.replace_all(
+                        substitutions, max_dim, cache, max_order,
+                        masses).operators
+                elif dimension < max_dim:
+                    new_ops = operator.replace_first(
+                        present[0], substitutions[present[0]], max_dim,
+                        max_order=max_order, masses=masses)
+                    pending.extend(reversed(new_ops.operators))
+        return OperatorSum(result)
+
+def collect_numbers(operator):
+    """
+    Collect all the tensors representing numbers into a single one.
+
+    A tensor is understood to represent a number when its name
+    is ``"$number"`` or ``$i``.
+    """
+    new_tensors = []
+    number = 1
+    i_count = 0
+    is_complex = False
+    for tensor in operator.tensors:
+        if tensor.name == "$number":
+            if tensor.content.imag != 0:
+                is_complex = True
+            number *= tensor.content
+        elif tensor.name == "$i":
+            i_count += 1
         else:
-            return OperatorSum(result)
+            new_tensors.append(tensor)
+
+    if is_complex:
+        number *= {0: 1, 1: 1j, 2: -1, 3: -1j}[i_count % 4]
+    else:
+        number, i_tensors = {
+            0: (number, []),
+            1: (number, i_op.tensors),
+            2: (-number, []),
+            3: (-number, i_op.tensors)}[i_count % 4]
+        new_tensors = i_tensors + new_tensors
+
+    # Remove coefficients 1
+    if number == 1:
+        return Operator(new_tensors)
+
+    return Operator(number_op(number).tensors + new_tensors)
+
+def collect_powers(operator):
+    """
+    Collect all the tensors that are equal and return the correspondin
+    powers.
+    """
+    new_tensors = []
+    symbols = {}
+    for tensor in operator.tensors:
+        if tensor.is_field or tensor.name[0] == "$" or tensor.exponent is None:
+            new_tensors.append(tensor)
+        else:
+            # Previusly collected exponent for same base and indices
+            prev_exponent = symbols.get((tensor.name, tuple(tensor.indices)), 0)
+            
+            # The exponents of a product are added
+            symbols[(tensor.name, tuple(tensor.indices))] = (
+                tensor.exponent + prev_exponent)
+
+    # Remove tensors with exponent 0
+    power_tensors = [Tensor(name, inds, exponent=exponent)
+                     for (name, inds), exponent in symbols.items()
+                     if exponent != 0]
+
+    return Operator(power_tensors + new_tensors)
+
+def normalize(operator):
+    """
+    Collect the numbers and the powers of the tensors of an operator
+    (see :func:`collect_numbers` and :func:`collect_powers`).
+    """
+    return collect_numbers(collect_powers(operator))
+
+def inverse_mass_order(tensors, masses):
+    """
+    Compute the order in the inverse of the masses of a list of tensors.
+
+    Masses are represented by tensors with their names in ``masses``,
+    usually exponentiated (see :func:`power_op`). Their indices (for
+    example, flavor indices) are ignored.
+
+    Args:
+        tensors ([Tensor])
+        masses (frozenset of strings): names of the mass tensors
+
+    Return:
+        minus the sum of the exponents of the mass tensors
+    """
+    order = 0
+    for tensor in tensors:
+        if tensor.name in masses:
+            order -= 1 if tensor.exponent is None else tensor.exponent
+    return order
+
+class SubstitutionCache(object):
+    """
+    Memo of the results of :meth:`Operator.replace_first` and
+    :meth:`Operator.replace_all`, bounded to the least recently used
+    entries.
+
+    The results are stored for the canonical operator (see
+    :meth:`Operator.canonical_operator`), so that they can be reused
+    for any operator with the same canonical form, whatever the order
+    of its tensors and the labels of its indices. Operators whose
+    canonical sign is 0 are never cached.
+
+    A cache is only valid as long as the replacements that are used
+    with it aren't modified.
+
+    Attributes:
+        max_size (int): maximum number of stored results
+        hits (int): number of results found in the cache
+        misses (int): number of results not found in the cache
+    """
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """Remove all the stored results and reset the counters"""
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key, substitutions):
+        """
+        Return the list of operators stored with the given key for the
+        given substitutions object, or None if there is none.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None or entry[0] is not substitutions:
+            self.misses += 1
+            return None
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[1]
+
+    def store(self, key, substitutions, operators):
+        """Store a list of operators with the given key"""
+        self._entries.pop(key, None)
+        self._entries[key] = (substitutions, operators)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
 
 def rest(lst, index):
     return lst[:index] + lst[index+1:]
@@ -476,7 +1019,7 @@ def leibniz_rule(index, operator):
     result = []
     for i, tensor in enumerate(operator.tensors):
         if tensor.is_field:
-            new_indices = [index] + tensor.indices
+            new_indices = (index,) + tensor.indices
             new_tensor = Tensor(tensor.name, new_indices, is_field=True,
                                 num_of_der=tensor.num_of_der + 1,
                                 dimension=tensor.dimension,
@@ -485,75 +1028,517 @@ def leibniz_rule(index, operator):
                                    operator.tensors[i+1:]))
     return OperatorSum(result)
 
-def apply_derivatives(indices, target):
-    """Applies any number of derivatives to an Operator or OperatorSum"""
+def distribute_derivatives(indices, operator):
+    """
+    Apply several derivatives to an operator at once, using the
+    multinomial Leibniz rule.
+
+    The result is the same as applying :func:`leibniz_rule` once for
+    each index, from the last one to the first, except for the
+    operators where the same indices end up acting on the same fields,
+    in the same order. These appear when some index is repeated and
+    are merged as they are produced, keeping only the first one,
+    multiplied by the number of times it appears.
+
+    Args:
+        indices ([int]): indices of the derivatives
+        operator (Operator): operator to which the derivatives are
+                             to be applied
+
+    Return:
+        An OperatorSum with the distinct operators
+    """
+    positions = [i for i, tensor in enumerate(operator.tensors)
+                 if tensor.is_field]
+    # For each distribution of the derivatives among the fields, the
+    # indices of the derivatives acting on each one and its multiplicity
+    distributions = OrderedDict([(((),) * len(positions), 1)])
     for index in reversed(indices):
-        target = target.derivative(index)
-    return target
+        new_distributions = OrderedDict()
+        for distribution, multiplicity in distributions.items():
+            for k, der_indices in enumerate(distribution):
+                new_distribution = (distribution[:k] +
+                                    ((index,) + der_indices,) +
+                                    distribution[k+1:])
+                new_distributions[new_distribution] = (
+                    new_distributions.get(new_distribution, 0) +
+                    multiplicity)
+        distributions = new_distributions
 
-def match_tensor_lists_aux(lst, pattern):
-    if not pattern:
-        return [tuple(pos for pos, _ in lst)]
-    results = []
-    for i, (pos, tensor) in enumerate(lst):
-        if (tensor.name == pattern[0].name and
-            tensor.num_of_der == pattern[0].num_of_der and
-            tensor.content == pattern[0].content and
-            tensor.exponent == pattern[0].exponent):
-            match_rest = match_tensor_lists_aux(rest(lst, i), pattern[1:])
-            results += [(pos,) + prev for prev in match_rest]
-    return results
+    result = []
+    for distribution, multiplicity in distributions.items():
+        tensors = list(operator.tensors)
+        for position, der_indices in zip(positions, distribution):
+            tensor = tensors[position]
+            tensors[position] = Tensor(
+                tensor.name, der_indices + tensor.indices, is_field=True,
+                num_of_der=tensor.num_of_der + len(der_indices),
+                dimension=tensor.dimension, statistics=tensor.statistics)
+        new_operator = Operator(tensors)
+        if multiplicity > 1:
+            new_operator *= number_op(multiplicity)
+        result.append(new_operator)
+    return OperatorSum(result)
 
-def match_tensor_lists(lst, pattern):
+def apply_derivatives(indices, target):
+    """
+    Applies any number of derivatives to an Operator or OperatorSum
+    (see :func:`distribute_derivatives`)
     """
-    Match the names of a pattern list of tensors in another list of tensors
+    if not indices:
+        return target
+    if isinstance(target, Operator):
+        return distribute_derivatives(indices, target)
+    return OperatorSum(concat([distribute_derivatives(indices, op).operators
+                               for op in target.operators]))
+
+class Pattern(object):
+    """
+    Compiled form of an operator that is to be found inside others.
 
-    Reorderings of the main list are considered.
+    Everything that :func:`match_tensor_lists` needs to know about the
+    pattern is computed once, when the object is created, so that it
+    can be reused for any number of matchings.
+
+    Attributes:
+        operator (Operator): the original pattern
+        tensors ([Tensor]): the tensors of the pattern
+        name_counts (dict): the number of tensors with each name
+        contractions (dict): for each contracted index, the list of
+            pairs ``(position, slot)`` where it appears
+        free_slots (list of pairs): the pair ``(position, slot)`` where
+            each of the free indices -1, -2, ... appears
+        bindings (list of lists): for the tensor at each position, the
+            triples ``(slot, index, first)`` where ``first`` specifies
+            whether the index appears there for the first time
+        fermions (list of ints): the positions of the fermions
+    """
+    def __init__(self, operator):
+        self.operator = operator
+        self.tensors = operator.tensors
+        self.name_counts = {}
+        self.contractions = {}
+        free_slots = {}
+        self.bindings = []
+        seen = set()
+        for pos, tensor in enumerate(self.tensors):
+            self.name_counts[tensor.name] = (
+                self.name_counts.get(tensor.name, 0) + 1)
+            binding = []
+            for slot, index in enumerate(tensor.indices):
+                if index < 0:
+                    free_slots.setdefault(-index - 1, (pos, slot))
+                else:
+                    self.contractions.setdefault(index, []).append((pos, slot))
+                binding.append((slot, index, index not in seen))
+                seen.add(index)
+            self.bindings.append(binding)
+        self.free_slots = [free_slots[i] for i in range(len(free_slots))]
+        self.fermions = [pos for pos, tensor in enumerate(self.tensors)
+                         if tensor.statistics == fermion]
+
+    def __len__(self):
+        return len(self.tensors)
+
+def match_tensor_lists(lst, pattern, symmetries=None, positions=None):
+    """
+    Match a pattern list of tensors in another list of tensors.
+
+    Reorderings of the main list are considered. The pattern tensors are
+    assigned one by one (in order) to tensors of lst with the same name,
+    number of derivatives, content and exponent, checking at each step
+    that the contractions of indices are consistent with those of the
+    pattern. Partial assignments that break them are abandoned.
+
+    Interchangeable tensors of lst (see :func:`tensor_symmetries`) are
+    treated as a multiset: among several unused equivalent choices only
+    the first one is explored. The matches that are skipped are
+    equivalent to some produced one and never come before it.
 
     Args:
         lst ([Tensor]): list inside which the pattern is to be found
-        pattern ([Tensor]): pattern to find
+        pattern (Pattern or [Tensor]): pattern to find
+        symmetries (function): returns the result of
+            :func:`tensor_symmetries` for lst (for example, from a cache).
+            Only called when a second choice for some tensor is tried.
+        positions (dict): the positions of the tensors of lst for each
+            name (as given by :meth:`Operator.positions`), if known.
 
     Return:
-        A list of tuples of integers. Each tuple represents a reordering
-        of the positions of the tensors in lst that matches the names of
-        the pattern in its first elements.
+        A generator of pairs ``(match, free_indices)``, lazily produced.
+        ``match`` is a tuple of integers representing a reordering of
+        the positions of the tensors in lst that matches the pattern
+        in its first elements. ``free_indices`` is the list of the indices
+        of lst that correspond to the free indices of the pattern.
+    """
+    if not isinstance(pattern, Pattern):
+        pattern = Pattern(Operator(list(pattern)))
+    if len(pattern) > len(lst):
+        return
+    if positions is None:
+        positions = {}
+        for pos, tensor in enumerate(lst):
+            positions.setdefault(tensor.name, []).append(pos)
+    for name, count in pattern.name_counts.items():
+        if len(positions.get(name, ())) < count:
+            return
+    candidates = []
+    for pattern_tensor in pattern.tensors:
+        candidates.append([
+            pos for pos in positions[pattern_tensor.name]
+            if (lst[pos].num_of_der == pattern_tensor.num_of_der and
+                lst[pos].content == pattern_tensor.content and
+                lst[pos].exponent == pattern_tensor.exponent)])
+        if not candidates[-1]:
+            return
+    bindings = pattern.bindings
+    used = [False] * len(lst)
+    match = []
+    pattern_to_lst = {}
+    lst_to_pattern = {}
+
+    # Symmetry data, computed only when a second choice is considered
+    # (the first unused candidate can't be equivalent to a previous one)
+    symmetry_data = []
+
+    def is_redundant(pos):
+        """
+        Check whether an unused position is equivalent to a previous
+        one through an exchange of tensors that leaves the used ones
+        in place.
+        """
+        if not symmetry_data:
+            data = tensor_symmetries(lst) if symmetries is None else symmetries()
+            num_used_in_component = [0] * (max(data[1]) + 1)
+            for other_pos, is_used in enumerate(used):
+                if is_used:
+                    num_used_in_component[data[1][other_pos]] += 1
+            symmetry_data.extend(data + (num_used_in_component,))
+        copies, components, images, num_used_in_component = symmetry_data
+        if any(not used[copy] for copy in copies[pos]):
+            return True
+        return (num_used_in_component[components[pos]] == 0 and
+                any(num_used_in_component[component] == 0
+                    for component, image in images[pos]))
+
+    def set_used(pos, value):
+        used[pos] = value
+        if symmetry_data:
+            symmetry_data[3][symmetry_data[1][pos]] += 1 if value else -1
+
+    def bind(pos, k):
+        """
+        Extend the correspondence between pattern and lst indices with
+        those of the tensors at pos and k. Return the pattern indices
+        added, or None if they are inconsistent.
+        """
+        indices = lst[pos].indices
+        added = []
+        for slot, pattern_index, first in bindings[k]:
+            if slot >= len(indices):
+                break
+            index = indices[slot]
+            if first:
+                if index in lst_to_pattern:
+                    break
+                pattern_to_lst[pattern_index] = index
+                lst_to_pattern[index] = pattern_index
+                added.append(pattern_index)
+            elif pattern_to_lst[pattern_index] != index:
+                break
+        else:
+            return added
+        unbind(added)
+        return None
+
+    def unbind(added):
+        for pattern_index in added:
+            del lst_to_pattern[pattern_to_lst.pop(pattern_index)]
+
+    def assign(k):
+        if k == len(bindings):
+            free_indices = [lst[match[pos]].indices[slot]
+                            for pos, slot in pattern.free_slots]
+            yield (tuple(match) +
+                   tuple(pos for pos in range(len(lst)) if not used[pos]),
+                   free_indices)
+            return
+        tried = False
+        for pos in candidates[k]:
+            if used[pos] or (tried and is_redundant(pos)):
+                continue
+            tried = True
+            added = bind(pos, k)
+            if added is None:
+                continue
+            set_used(pos, True)
+            match.append(pos)
+            for result in assign(k + 1):
+                yield result
+            match.pop()
+            set_used(pos, False)
+            unbind(added)
+
+    for result in assign(0):
+        yield result
+
+def _content_key(content):
+    """Comparable representation of the ``content`` of a tensor"""
+    if content is None:
+        return ()
+    if isinstance(content, tuple):
+        return tuple(_tensor_key(tensor) + (tensor.indices,)
+                     for tensor in content)
+    number = complex(content)
+    return (number.real, number.imag)
+
+def _tensor_key(tensor):
+    """
+    Comparable representation of the attributes of a tensor that are
+    taken into account when matching it (everything but the indices).
     """
-    if (len(pattern) > len(lst) or
-        not all(t1.name in [t2.name for t2 in lst] for t1 in pattern)):
-        return []
-    return match_tensor_lists_aux(list(enumerate(lst)), pattern)
+    exponent = () if tensor.exponent is None else (tensor.exponent,)
+    return (tensor.name, tensor.num_of_der, exponent,
+            _content_key(tensor.content))
 
-def match_indices(lst, pattern):
+def _rank(data):
+    """Replace each element of data by its position in the sorted set"""
+    ranks = {value: rank for rank, value in enumerate(sorted(set(data)))}
+    return [ranks[value] for value in data]
+
+def _refine(colors, neighbours):
+    """
+    Refine a coloring of the tensors of an operator until the colors
+    of the tensors contracted with each tensor don't split any color.
+    """
+    num_of_colors = len(set(colors))
+    while num_of_colors < len(colors):
+        colors = _rank([
+            (colors[i], tuple(sorted((slot, colors[j], other_slot)
+                                     for slot, j, other_slot in nbs)))
+            for i, nbs in enumerate(neighbours)])
+        new_num_of_colors = len(set(colors))
+        if new_num_of_colors == num_of_colors:
+            break
+        num_of_colors = new_num_of_colors
+    return colors
+
+def _encode(tensors, keys, order):
     """
-    Match the index structure of a pattern list of tensors in another
-    list of tensors without reorderings
+    Encode the tensors in the given order, relabelling the contracted
+    indices by order of appearance and keeping the free ones.
+    """
+    labels = {}
+    encoding = []
+    for pos in order:
+        new_indices = []
+        for index in tensors[pos].indices:
+            if index >= 0:
+                index = labels.setdefault(index, len(labels))
+            new_indices.append(index)
+        encoding.append((keys[pos], tuple(new_indices)))
+    return tuple(encoding)
+
+def canonical_form(tensors):
+    """
+    Find a canonical form for a list of tensors with contracted indices.
+
+    Two lists of tensors represent equal operators (in the sense of
+    :meth:`Operator.__eq__`) if and only if their keys are equal and
+    their signs are equal or zero.
+
+    The canonical order is found by iterative refinement of a coloring
+    of the tensors according to their contractions. When the refinement
+    leaves several indistinguishable tensors, the ways of individualizing
+    them are tried and the one giving the smallest key is chosen. The
+    automorphisms found in the process are used to skip the choices that
+    are equivalent to already explored ones.
 
     Args:
-        lst ([Tensor]): list inside which the pattern is to be found
-        pattern ([Tensor]): pattern to find
+        tensors ([Tensor]): the tensors of the operator
 
     Return:
-        if they match: a pair with the first element being True and the
-                       second one being a list of the indices of lst that
-                       correspond to the free indices of pattern
-        otherwise: a pair (False, None)
-    """
-    # Check the index structure
-    for (pos1, t1), (pos2, t2) in enum_product(pattern, pattern):
-        for (i, i1), (j, i2) in enum_product(t1.indices, t2.indices):
-            li1 = lst[pos1].indices[i]
-            li2 = lst[pos2].indices[j]
-            if not ((i1 == i2) == (li1 == li2)):
-                return False, None
-
-    # Find the indices of lst correponding to the free ones of pattern
-    free_indices = [0] * sum([1 for t in pattern for i in t.indices if i < 0])
-    for pos, tensor in enumerate(pattern):
-        for i, index in enumerate(tensor.indices):
-            if index < 0:
-                free_indices[-index-1] = lst[pos].indices[i]
-    return True, free_indices
+        A triple ``(key, sign, order)``. ``key`` is a hashable tuple
+        containing the tensors in canonical order with the contracted
+        indices relabelled as 0, 1, 2... by order of appearance.
+        ``sign`` is the sign of the permutation of the fermions that
+        reorders them canonically, or 0 when there are reorderings with
+        both signs (the operator is then equal to minus itself).
+        ``order`` is the list of the positions of the tensors in
+        canonical order.
+    """
+    keys = [_tensor_key(tensor) for tensor in tensors]
+    occurrences = {}
+    for pos, tensor in enumerate(tensors):
+        for slot, index in enumerate(tensor.indices):
+            if index >= 0:
+                occurrences.setdefault(index, []).append((pos, slot))
+    neighbours = [
+        [(slot, other_pos, other_slot)
+         for slot, index in enumerate(tensor.indices) if index >= 0
+         for other_pos, other_slot in occurrences[index]
+         if (other_pos, other_slot) != (pos, slot)]
+        for pos, tensor in enumerate(tensors)]
+    local_patterns = []
+    for tensor in tensors:
+        local_labels = {}
+        local_patterns.append(tuple(
+            (0, index) if index < 0 else
+            (1, len(occurrences[index]),
+             local_labels.setdefault(index, len(local_labels)))
+            for index in tensor.indices))
+
+    # Identical tensors (with the same indices) are interchangeable:
+    # number them to avoid exploring their permutations
+    copies = {}
+    copy_numbers = []
+    for key, tensor in zip(keys, tensors):
+        copy_number = copies.get((key, tensor.indices), 0)
+        copies[(key, tensor.indices)] = copy_number + 1
+        copy_numbers.append(copy_number)
+    colors = _refine(_rank(list(zip(keys, local_patterns, copy_numbers))),
+                     neighbours)
+
+    is_fermion = [tensor.statistics == fermion for tensor in tensors]
+    best = [None, set(), None]
+    automorphisms = []
+
+    def is_equivalent(pos, explored, path):
+        """
+        Check whether pos is in the orbit of some explored position under
+        the group generated by the known automorphisms that fix the path.
+        """
+        parent = list(range(len(tensors)))
+
+        def find(pos):
+            while parent[pos] != pos:
+                pos = parent[pos]
+            return pos
+
+        for automorphism in automorphisms:
+            if all(automorphism[fixed] == fixed for fixed in path):
+                for source, image in enumerate(automorphism):
+                    root, other_root = find(source), find(image)
+                    if root != other_root:
+                        parent[max(root, other_root)] = min(root, other_root)
+        return find(pos) in set(map(find, explored))
+
+    def search(colors, path):
+        cells = {}
+        for pos, color in enumerate(colors):
+            cells.setdefault(color, []).append(pos)
+        ties = [cell for color, cell in sorted(cells.items())
+                if len(cell) > 1]
+        if not ties:
+            order = sorted(range(len(colors)), key=colors.__getitem__)
+            encoding = _encode(tensors, keys, order)
+            sign = reordering_sign([pos for pos in order if is_fermion[pos]])
+            if best[0] is None or encoding < best[0]:
+                best[:] = [encoding, {sign}, order]
+            elif encoding == best[0]:
+                best[1].add(sign)
+                automorphism = [None] * len(order)
+                for best_pos, pos in zip(best[2], order):
+                    automorphism[best_pos] = pos
+                automorphisms.append(automorphism)
+            return
+        explored = []
+        for pos in ties[0]:
+            # Skip the positions known to be equivalent to explored ones
+            if explored and is_equivalent(pos, explored, path):
+                continue
+            explored.append(pos)
+            individualized = _rank([(color, other_pos != pos)
+                                    for other_pos, color in enumerate(colors)])
+            search(_refine(individualized, neighbours), path + [pos])
+
+    search(colors, [])
+    key, signs, order = best
+
+    # Exchanging two identical fermions gives a minus sign
+    if any(copy_number > 0 and tensor.statistics == fermion
+           for copy_number, tensor in zip(copy_numbers, tensors)):
+        signs.add(-1)
+        signs.add(1)
+    sign = signs.pop() if len(signs) == 1 else 0
+    return key, sign, order
+
+def tensor_symmetries(tensors):
+    """
+    Find the tensors of an operator that can be exchanged without
+    changing it (up to a relabelling of contracted indices and a sign).
+
+    Two tensors are interchangeable if they are identical (including
+    their indices). Two connected components of the operator (sets of
+    tensors linked by contractions) are interchangeable if they have
+    the same canonical form.
+
+    Args:
+        tensors ([Tensor]): the tensors of the operator
+
+    Return:
+        A triple ``(copies, components, images)`` of lists indexed by
+        position. ``copies[pos]`` contains the positions before pos of
+        the identical tensors. ``components[pos]`` is the number of the
+        connected component containing pos. ``images[pos]`` contains a
+        pair ``(component, image)`` for each component interchangeable
+        with that of pos such that the image of pos by the exchange is
+        the position ``image`` and comes before pos.
+    """
+    first_positions = {}
+    copies = []
+    for pos, tensor in enumerate(tensors):
+        copies.append(first_positions.setdefault(tensor, []))
+        first_positions[tensor] = copies[-1] + [pos]
+
+    # Connected components
+    parent = list(range(len(tensors)))
+
+    def find(pos):
+        while parent[pos] != pos:
+            pos = parent[pos]
+        return pos
+
+    owners = {}
+    for pos, tensor in enumerate(tensors):
+        for index in tensor.indices:
+            other = owners.setdefault(index, pos)
+            root, other_root = find(pos), find(other)
+            if root != other_root:
+                parent[max(root, other_root)] = min(root, other_root)
+    roots = [find(pos) for pos in range(len(tensors))]
+    numbers = {root: number
+               for number, root in enumerate(sorted(set(roots)))}
+    components = [numbers[root] for root in roots]
+    members = [[] for _ in numbers]
+    for pos, component in enumerate(components):
+        members[component].append(pos)
+
+    # Interchangeable components, with their tensors in canonical order.
+    # Canonical forms are only needed for components with the same names
+    candidates = {}
+    for component, positions in enumerate(members):
+        names = tuple(sorted(tensors[pos].name for pos in positions))
+        candidates.setdefault(names, []).append(component)
+    classes = {}
+    canonical_members = {}
+    for components_with_names in candidates.values():
+        if len(components_with_names) < 2:
+            continue
+        for component in components_with_names:
+            positions = members[component]
+            key, _, order = canonical_form([tensors[pos] for pos in positions])
+            canonical_members[component] = [positions[i] for i in order]
+            classes.setdefault(key, []).append(component)
+    images = [[] for _ in tensors]
+    for equivalent_components in classes.values():
+        for component in equivalent_components:
+            for rank, pos in enumerate(canonical_members[component]):
+                for other in equivalent_components:
+                    image = canonical_members[other][rank]
+                    if other != component and image < pos:
+                        images[pos].append((other, image))
+    return copies, components, images
 
 class TensorBuilder(object):
     """
@@ -5,30 +5,66 @@ for representing the different types of heavy fields.
 """
 
 import sys
+import warnings
 from fractions import Fraction
 
 from matchingtools.core import (
-    Tensor, Op, OpSum,
+    Tensor, Op, OpSum, SubstitutionCache,
     apply_derivatives, concat, i_op, number_op, power_op,
     generic, boson, fermion,
     sigma4, sigma4bar, epsUp, epsUpDot, epsDown, epsDownDot)
 
-class Scalar(object):
-    """Provide a propagator for scalars."""
-    
-    def apply_diff_op(self, operator_sum):
-        """Apply the differential operator -D^2/M^2."""
-        final_op_sum = OpSum()
-        for operator in operator_sum.operators:
-            new_ind = operator.max_index + 1
-            final_op_sum += apply_derivatives(
-                [new_ind, new_ind],
-                -self.free_inv_mass_sq * operator)
-        return final_op_sum
+from matchingtools.parallel import map_chunks
+
+def propagator_template(apply_diff_op, num_of_inds, max_order, coef_op):
+    """
+    Expand a propagator acting on a generic source.
+
+    The source is represented by ``generic(-1, -2, ..., -num_of_inds)``,
+    so that the propagator can be applied to any operator sum by
+    replacing it.
+
+    Args:
+        apply_diff_op (function): applies the differential operator of
+            the expansion to an operator sum
+        num_of_inds (int): number of indices of the source
+        max_order (int): maximum order in the derivatives to which
+            the propagator is to be expanded
+        coef_op (Operator): overall coefficient
+
+    Return:
+        OperatorSum with the terms of the expansion
+    """
+    source = OpSum(Op(generic(*range(-1, -num_of_inds - 1, -1))))
+    final_op_sum = source
+    operator_sum = source
+    for order in range(0, max_order + 1, 2):
+        operator_sum = apply_diff_op(operator_sum)
+        final_op_sum += operator_sum
+    return OpSum(*[op * coef_op for op in final_op_sum.operators])
+
+class Propagator(object):
+    """
+    Provide the expansion of the propagator of a heavy boson.
+
+    The subclasses define the differential operator of the expansion,
+    ``apply_diff_op``, and its overall coefficient, ``propagator_coef``.
+    """
+
+    def propagator_template(self, max_order):
+        """
+        Compute (once for each order) the expansion of the propagator
+        for a generic source (see :func:`propagator_template`).
+        """
+        if max_order not in self.propagators:
+            self.propagators[max_order] = propagator_template(
+                self.apply_diff_op, self.num_of_inds, max_order,
+                self.propagator_coef())
+        return self.propagators[max_order]
 
     def apply_propagator(self, operator_sum, max_order, max_dim):
         """
-        Apply the scalar propagator -(D^2 + M^2)^(-1).
+        Apply the propagator of the subclass.
 
         Args:
             operator_sum (OperatorSum): the propagator is to be applied to it
@@ -39,17 +75,32 @@ class Scalar(object):
         Return:
             OperatorSum of the operators with the propagator applied.
         """
-        final_op_sum = operator_sum
-        for order in range(0, max_order + 1, 2):
-            operator_sum = self.apply_diff_op(operator_sum)
-            final_op_sum += operator_sum
-        coef_op = -self.free_inv_mass_sq
-        return OpSum(*[op * coef_op for op in final_op_sum.operators
-                       if op.dimension <= self.max_dim])
+        return self.propagator_template(max_order).replace_all(
+            {"generic": operator_sum}, max_dim)
+
+class Scalar(Propagator):
+    """Provide a propagator for scalars: -(D^2 + M^2)^(-1)."""
+    
+    def apply_diff_op(self, operator_sum):
+        """Apply the differential operator -D^2/M^2."""
+        final_op_sum = OpSum()
+        for operator in operator_sum.operators:
+            new_ind = operator.max_index + 1
+            final_op_sum += apply_derivatives(
+                [new_ind, new_ind],
+                -self.free_inv_mass_sq * operator)
+        return final_op_sum
+
+    def propagator_coef(self):
+        """Overall coefficient of the propagator: -1/M^2."""
+        return -self.free_inv_mass_sq
 
     
-class Vector(object):
-    """Provide a propagator for vectors."""
+class Vector(Propagator):
+    """
+    Provide a propagator for vectors:
+    [(M^2 + D^2) eta_{munu} - D_mu D_nu]^(-1).
+    """
     
     def apply_diff_op(self, operator_sum):
         """
@@ -68,30 +119,28 @@ class Vector(object):
         structure = (OpSum(self.free_inv_mass_sq) * generic_der_1 +
                      OpSum(number_op(-1) * self.free_inv_mass_sq) *
                      generic_der_2)
-        return structure.replace_all({"generic": operator_sum}, 6)
+        # Single replacements, as operator_sum may be a generic source
+        return OpSum(*concat([
+            operator.replace_first("generic", operator_sum).operators
+            for operator in structure.operators]))
 
-    def apply_propagator(self, operator_sum, max_order, max_dim):
-        """
-        Apply the vector propagator [(M^2 + D^2) eta_{munu} - D_mu D_nu]^(-1).
+    def propagator_coef(self):
+        """Overall coefficient of the propagator: 1/M^2."""
+        return self.free_inv_mass_sq
 
-        Args:
-            operator_sum (OperatorSum): the propagator is to be applied to it
-            max_order=2 (int): maximum order in the derivatives to which
-                               the propagator is to be expanded 
-            max_dim=4 (int): maximum dimension of the resulting operators
 
-        Return:
-            OperatorSum of the operators with the propagator applied.
-        """
-        final_op_sum = operator_sum
-        for order in range(0, max_order + 1, 2):
-            operator_sum = self.apply_diff_op(operator_sum)
-            final_op_sum += operator_sum
-        coef_op = self.free_inv_mass_sq
-        return OpSum(*[op * coef_op for op in final_op_sum.operators
-                       if op.dimension <= max_dim])
+def expansion_defaults(field, order, max_dim):
+    """
+    Choose the order and maximum dimension of the expansion of the
+    propagator of a heavy boson: the given ones if they are not None,
+    then the attributes of the field and, at last, 2 and 4.
+    """
+    if order is None:
+        order = 2 if field.order is None else field.order
+    if max_dim is None:
+        max_dim = 4 if field.max_dim is None else field.max_dim
+    return order, max_dim
 
-                
 class RealBoson(object):
     """
     Provide the EOMs and attributes for real bosons.
@@ -103,14 +152,21 @@ class RealBoson(object):
                                      squared tensor with a free index
         mass_sq (Operator): operator containing the mass squared tensor
                             non-negative index (ready to appear directly)
+        propagators (dict): expansion of the propagator for a generic
+                            source for each order computed so far
     """
-    def __init__(self, name, num_of_inds, has_flavor=True, order=2, max_dim=4):
+    def __init__(self, name, num_of_inds, has_flavor=True, order=None,
+                 max_dim=None):
         """
         Args:
             name (string): name identifier of the corresponding tensor
             num_of_inds (int): number of indices of the corr. tensor
             has_flavor (bool): specifies if there are several generations
-            order (int): maximum order in the derivatives for the propagator
+            order (int): maximum order in the derivatives for the propagator.
+                If None, the smallest one needed is used
+                (see :func:`propagator_expansions`)
+            max_dim (int): maximum dimension of the solutions of the EOMs.
+                If None, the smallest one needed is used
         """
         self.name = name
         self.num_of_inds = num_of_inds
@@ -121,23 +177,50 @@ class RealBoson(object):
         self.mass_sq = power_op(mass, 2, indices=mass_inds)
         self.order = order
         self.max_dim = max_dim
+        self.propagators = {}
     
-    def equations_of_motion(self, interaction_lagrangian):
+    def sources(self, interaction_lagrangian):
+        """
+        Compute the source of the EOMs, to which the propagator is applied.
+
+        Return:
+            A single-element list with a pair whose second
+            element is the source
+        """
+        return [(self.name,
+                 -interaction_lagrangian.variation(self.name, True))]
+
+    def eom_names(self):
+        """
+        Names of the fields whose EOMs are given by :meth:`sources`
+        and :meth:`equations_of_motion`, in the same order.
+        """
+        return [self.name]
+
+    def equations_of_motion(self, interaction_lagrangian, order=None,
+                            max_dim=None, sources=None):
         """
         Solve the EOMs to given order in 1/M.
 
         Args:
             interaction_lagrangian (OperatorSum)
-            max_order=2 (int): maximum order in 1/M to which the propagator
-                               is to be expanded
-            max_dim=4 (int): maximum dimension of the resulting operators
+            order (int): maximum order in the derivatives to which the
+                propagator is to be expanded. Defaults to the ``order``
+                attribute or, if it is None, to 2
+            max_dim (int): maximum dimension of the resulting operators.
+                Defaults to the ``max_dim`` attribute or, if it is None,
+                to 4
+            sources (list of pairs): the result of :meth:`sources`,
+                if already computed
         Return:
             A single-element list with a pair whose second
             element is the solution to the EOMs
         """
-        variation = interaction_lagrangian.variation(self.name, True)
-        return [(self.name,
-                 self.apply_propagator(-variation, self.order, self.max_dim))]
+        order, max_dim = expansion_defaults(self, order, max_dim)
+        if sources is None:
+            sources = self.sources(interaction_lagrangian)
+        return [(name, self.apply_propagator(source, order, max_dim))
+                for name, source in sources]
 
 class ComplexBoson(object):
     """
@@ -151,16 +234,22 @@ class ComplexBoson(object):
                                      squared tensor with a free index
         mass_sq (Operator): operator containing the mass squared tensor
                             non-negative index (ready to appear directly)
+        propagators (dict): expansion of the propagator for a generic
+                            source for each order computed so far
     """
-    def __init__(self, name, c_name, num_of_inds, has_flavor=True, order=2,
-                 max_dim=4):
+    def __init__(self, name, c_name, num_of_inds, has_flavor=True,
+                 order=None, max_dim=None):
         """
         Args:
             name (string): name identifier of the corresponding tensor
             c_name (string): name identifier of the conjugate tensor
             num_of_inds (int): number of indices of the corr. tensor
             has_flavor (bool): specifies if there are several generations
-            order (int): maximum order in the derivatives for the propagator
+            order (int): maximum order in the derivatives for the propagator.
+                If None, the smallest one needed is used
+                (see :func:`propagator_expansions`)
+            max_dim (int): maximum dimension of the solutions of the EOMs.
+                If None, the smallest one needed is used
         """
         self.name = name
         self.c_name = c_name
@@ -172,30 +261,54 @@ class ComplexBoson(object):
         self.mass_sq = power_op(mass, 2, indices=mass_inds)
         self.order = order
         self.max_dim = max_dim
+        self.propagators = {}
 
-    def equations_of_motion(self, interaction_lagrangian):
+    def sources(self, interaction_lagrangian):
+        """
+        Compute the sources of the EOMs, to which the propagator is applied.
+
+        Return:
+            A two-element list with a pairs whose second
+            element are the sources for the field itself
+            and the complex conjugate, respectively
+        """
+        variations = interaction_lagrangian.variations(
+            [(self.name, boson), (self.c_name, boson)])
+        return [(self.name, -variations[self.c_name]),
+                (self.c_name, -variations[self.name])]
+
+    def eom_names(self):
+        """
+        Names of the fields whose EOMs are given by :meth:`sources`
+        and :meth:`equations_of_motion`, in the same order.
+        """
+        return [self.name, self.c_name]
+
+    def equations_of_motion(self, interaction_lagrangian, order=None,
+                            max_dim=None, sources=None):
         """
         Solve the EOMs to given order in 1/M.
 
         Args:
             interaction_lagrangian (OperatorSum)
-            max_order=2 (int): maximum order in 1/M to which the propagator
-                               is to be expanded
-            max_dim=4 (int): maximum dimension of the resulting operators
+            order (int): maximum order in the derivatives to which the
+                propagator is to be expanded. Defaults to the ``order``
+                attribute or, if it is None, to 2
+            max_dim (int): maximum dimension of the resulting operators.
+                Defaults to the ``max_dim`` attribute or, if it is None,
+                to 4
+            sources (list of pairs): the result of :meth:`sources`,
+                if already computed
         Return:
             A two-element list with a pairs whose second
             element are the solution to the EOMs for the field itself
             and the complex conjugate, respectively
         """
-        variation = interaction_lagrangian.variation(self.name, True)
-        c_variation = interaction_lagrangian.variation(self.c_name, True)
-        
-        return [(self.name,
-                 self.apply_propagator(
-                     -c_variation, self.order, self.max_dim)),
-                (self.c_name,
-                 self.apply_propagator(
-                     -variation, self.order, self.max_dim))]
+        order, max_dim = expansion_defaults(self, order, max_dim)
+        if sources is None:
+            sources = self.sources(interaction_lagrangian)
+        return [(name, self.apply_propagator(source, order, max_dim))
+                for name, source in sources]
 
 class RealScalar(RealBoson, Scalar):
     """
@@ -369,16 +482,33 @@ class VectorLikeFermion(object):
         return factor * f.derivative(n)
 
     def equations_of_motion(self, interaction_lagrangian):
-        L_variation = -interaction_lagrangian.variation(self.L_name, fermion)
-        R_variation = -interaction_lagrangian.variation(self.R_name, fermion)
-        Lc_variation = interaction_lagrangian.variation(self.Lc_name, fermion)
-        Rc_variation = interaction_lagrangian.variation(self.Rc_name, fermion)
+        variations = interaction_lagrangian.variations(
+            [(name, fermion) for name in [self.L_name, self.R_name,
+                                          self.Lc_name, self.Rc_name]])
+        L_variation = -variations[self.L_name]
+        R_variation = -variations[self.R_name]
+        Lc_variation = variations[self.Lc_name]
+        Rc_variation = variations[self.Rc_name]
         op_sum_inv_mass = OpSum(self.free_inv_mass)
         return [(self.L_name, op_sum_inv_mass * (self.R_der() + Rc_variation)),
                 (self.R_name, op_sum_inv_mass * (self.L_der() + Lc_variation)),
                 (self.Lc_name, op_sum_inv_mass * (self.Rc_der() + R_variation)),
                 (self.Rc_name, op_sum_inv_mass * (self.Lc_der() + L_variation))]
 
+    def eom_names(self):
+        """
+        Names of the fields whose EOMs are given by :meth:`sources`
+        and :meth:`equations_of_motion`, in the same order.
+        """
+        return [self.L_name, self.R_name, self.Lc_name, self.Rc_name]
+
+    def sources(self, interaction_lagrangian):
+        """
+        Return the EOMs, as no propagator is applied to them
+        (see :meth:`RealBoson.sources`).
+        """
+        return self.equations_of_motion(interaction_lagrangian)
+
     def _create_op_field(self, name):
         return Op(Tensor(name, list(range(self.num_of_inds)), is_field=True,
                          dimension=1.5, statistics=fermion))
@@ -456,12 +586,28 @@ class MajoranaFermion(object):
 
     
     def equations_of_motion(self, interaction_lagrangian):
-        variation = interaction_lagrangian.variation(self.name, fermion)
-        c_variation = interaction_lagrangian.variation(self.c_name, fermion)
+        variations = interaction_lagrangian.variations(
+            [(self.name, fermion), (self.c_name, fermion)])
+        variation = variations[self.name]
+        c_variation = variations[self.c_name]
         inv_mass = OpSum(self.free_inv_mass)
         return [(self.c_name, -inv_mass * self.pre_eps(self.der() + c_variation)),
                 (self.name, inv_mass * self.app_eps(self.c_der() + variation))]
 
+    def eom_names(self):
+        """
+        Names of the fields whose EOMs are given by :meth:`sources`
+        and :meth:`equations_of_motion`, in the same order.
+        """
+        return [self.c_name, self.name]
+
+    def sources(self, interaction_lagrangian):
+        """
+        Return the EOMs, as no propagator is applied to them
+        (see :meth:`RealBoson.sources`).
+        """
+        return self.equations_of_motion(interaction_lagrangian)
+
     def quadratic_terms(self):
         """
         Construct the terms (i Fc (D F) - i (D Fc) F - (FF + Fc Fc))/2
@@ -482,7 +628,299 @@ class MajoranaFermion(object):
         mass2 = self.mass * c_f * c_f1 * Op(epsUpDot(0, n))
         return half * (kin + kinc + OpSum(mass1, -mass2))
 
-def integrate(heavy_fields, interaction_lagrangian, max_dim=6, verbose=True):
+def eoms_dependency_groups(eoms):
+    """
+    Group the fields whose EOMs depend on each other.
+
+    The EOM solution of a field depends on another field when the
+    latter appears in it. The groups are the strongly connected
+    components of this dependency graph, found with Tarjan's algorithm.
+
+    Args:
+        eoms (dict): EOM solutions (OperatorSum) for each field name
+
+    Return:
+        A list of lists of field names, such that each group only
+        depends on itself and on the groups that come before it.
+    """
+    names = list(eoms.keys())
+    dependencies = {}
+    for name in names:
+        present = eoms[name].field_index()
+        dependencies[name] = [other for other in names if other in present]
+
+    groups = []
+    numbers = {}
+    lowest = {}
+    stack = []
+    on_stack = set()
+
+    def visit(name):
+        numbers[name] = lowest[name] = len(numbers)
+        stack.append(name)
+        on_stack.add(name)
+        for other in dependencies[name]:
+            if other not in numbers:
+                visit(other)
+                lowest[name] = min(lowest[name], lowest[other])
+            elif other in on_stack:
+                lowest[name] = min(lowest[name], numbers[other])
+        if lowest[name] == numbers[name]:
+            group = []
+            while True:
+                other = stack.pop()
+                on_stack.remove(other)
+                group.append(other)
+                if other == name:
+                    break
+            groups.append([other for other in names if other in group])
+
+    for name in names:
+        if name not in numbers:
+            visit(name)
+    return groups
+
+def solve_eoms(eoms, max_dim, cache=None, max_order=None, masses=None,
+               previous=None, changed=()):
+    """
+    Substitute the heavy fields inside the EOM solutions of each other.
+
+    The groups given by :func:`eoms_dependency_groups` are solved in
+    order. Inside a group, the fields are recursively replaced by their
+    EOM solutions, which, as the dimension increases in each step, solves
+    them order by order in the inverse masses up to ``max_dim``. The
+    solutions of the fields from previous groups are substituted directly.
+
+    Args:
+        eoms (dict): EOM solutions (OperatorSum) for each field name
+        max_dim (int): maximum dimension of the operators in the solutions
+        cache (``matchingtools.core.SubstitutionCache``): optional cache
+            for the substitutions
+        max_order (int): if given, maximum order in the inverse of the
+            masses of the operators in the solutions
+        masses (frozenset of strings): names of the mass tensors,
+            required when ``max_order`` is given
+        previous (dict): if given, solutions from a previous call that
+            are still valid for the fields not in ``changed``
+        changed (iterable of strings): names of the fields whose EOMs
+            have changed since ``previous`` was computed
+
+    Return:
+        A dict with the solutions in terms of light fields only
+
+    When ``previous`` is given, only the groups with a changed field or
+    depending on a group that is solved again are solved, and the rest
+    of the solutions are taken from ``previous`` (the same objects).
+    """
+    solutions = {}
+    changed = set(changed)
+    for group in eoms_dependency_groups(eoms):
+        if previous is not None and not any(
+                name in changed or
+                any(eoms[name].contains(other) for other in changed)
+                for name in group):
+            for name in group:
+                solutions[name] = previous[name]
+            continue
+        substitutions = {name: eoms[name] if name in group
+                         else solutions[name]
+                         for name in eoms
+                         if name in group or name in solutions}
+        for name in group:
+            solutions[name] = eoms[name].replace_all(
+                substitutions, max_dim, cache, max_order, masses)
+        changed.update(group)
+    return {name: solutions[name] for name in eoms}
+
+def dimension_profiles(operators, heavy_names):
+    """
+    Summarize the dimensions of some operators for
+    :func:`propagator_expansions`.
+
+    Args:
+        operators (list of Operator)
+        heavy_names (set of strings): names of the heavy fields
+
+    Return:
+        The set of the pairs with the dimension of the light part of
+        each operator (including all the derivatives) and the sorted
+        tuple of the names of the heavy fields in it
+    """
+    profiles = set()
+    for operator in operators:
+        light_dim = 0
+        heavy = []
+        for tensor in operator.tensors:
+            light_dim += tensor.num_of_der
+            if tensor.name in heavy_names:
+                heavy.append(tensor.name)
+            else:
+                light_dim += tensor.dimension
+        profiles.add((light_dim, tuple(sorted(heavy))))
+    return profiles
+
+def propagator_expansions(heavy_fields, field_names, source_profiles,
+                          lagrangian_profiles, max_dim):
+    """
+    Find the expansions of the propagators of the heavy bosons needed
+    for an effective lagrangian up to dimension ``max_dim``.
+
+    The lowest dimension of the solution of the EOMs of each heavy field
+    and the lowest dimension of the operators of the effective lagrangian
+    in which it appears are found from the dimensions of the operators
+    in the sources (see :meth:`RealBoson.sources`) and in the lagrangian.
+    Each D^2 in the expansion of a propagator raises them by 2, which
+    fixes the number of them that contribute. The expansion to order
+    ``n`` in the derivatives contains up to ``n/2 + 1`` of them.
+
+    When the order or the maximum dimension of a heavy boson has been
+    given to its constructor, it is kept, but a warning is issued if it
+    is not the needed one.
+
+    Args:
+        heavy_fields (list of heavy fields)
+        field_names (list of lists of strings): the names of the EOMs
+            of each heavy field
+        source_profiles (dict): the :func:`dimension_profiles` of the
+            source of the EOM with each name
+        lagrangian_profiles (set): the :func:`dimension_profiles` of the
+            lagrangian, including the quadratic terms of the heavy fields
+        max_dim (int): maximum dimension of the operators in the effective
+            lagrangian
+
+    Return:
+        A dict with, for the name of each heavy boson, a pair with the
+        order of the expansion of its propagator and the maximum
+        dimension of the solutions of its EOMs
+    """
+    infinity = float("inf")
+
+    def lowest_dimension(profile):
+        light_dim, heavy = profile
+        return light_dim + sum([solution_dims[name] for name in heavy])
+
+    # Lowest dimension of the solution of the EOMs of each field
+    solution_dims = dict.fromkeys(source_profiles, infinity)
+    changed = True
+    while changed:
+        changed = False
+        for name, profiles in source_profiles.items():
+            dimension = min([lowest_dimension(profile)
+                             for profile in profiles] + [infinity])
+            if dimension < solution_dims[name]:
+                solution_dims[name] = dimension
+                changed = True
+
+    # Lowest dimension of the operators in which each solution appears,
+    # either directly or inside the solution of another field
+    operator_dims = dict.fromkeys(source_profiles, infinity)
+    for profile in lagrangian_profiles:
+        dimension = lowest_dimension(profile)
+        for name in profile[1]:
+            operator_dims[name] = min(operator_dims[name], dimension)
+    changed = True
+    while changed:
+        changed = False
+        for name, profiles in source_profiles.items():
+            if operator_dims[name] == infinity:
+                continue
+            for profile in profiles:
+                dimension = (operator_dims[name] - solution_dims[name] +
+                             lowest_dimension(profile))
+                for other in profile[1]:
+                    if dimension < operator_dims[other]:
+                        operator_dims[other] = dimension
+                        changed = True
+
+    expansions = {}
+    for field, names in zip(heavy_fields, field_names):
+        if not isinstance(field, Propagator):
+            continue
+        insertions = 0
+        eoms_max_dim = 0
+        for name in names:
+            if operator_dims[name] <= max_dim:
+                insertions = max(insertions,
+                                 int((max_dim - operator_dims[name]) // 2))
+                eoms_max_dim = max(eoms_max_dim, max_dim -
+                                   operator_dims[name] + solution_dims[name])
+        order = 2 * max(insertions - 1, 0)
+        for attribute, needed in [("order", order),
+                                  ("max_dim", eoms_max_dim)]:
+            given = getattr(field, attribute)
+            if given is not None and given != needed:
+                warnings.warn(
+                    "{} {} for the EOMs of {} is {}: {} is needed for "
+                    "an effective lagrangian up to dimension {}".format(
+                        attribute, given, field.name,
+                        "insufficient" if given < needed else "wasteful",
+                        needed, max_dim))
+        expansions[field.name] = (
+            order if field.order is None else field.order,
+            eoms_max_dim if field.max_dim is None else field.max_dim)
+    return expansions
+
+def field_equations_of_motion(field, interaction_lagrangian, expansions,
+                              sources):
+    """
+    Compute the EOMs of a heavy field from its sources (see
+    :meth:`RealBoson.sources`), using the expansion of the propagator
+    given by :func:`propagator_expansions` for heavy bosons. The sources
+    of the other heavy fields are already their EOMs.
+    """
+    if field.name in expansions:
+        return field.equations_of_motion(interaction_lagrangian,
+                                         *expansions[field.name],
+                                         sources=sources)
+    return sources
+
+def _worker_settings(settings):
+    """Create the cache of a worker process of :func:`parallel_replace_all`"""
+    settings = dict(settings)
+    cache_size = settings.pop("cache_size")
+    settings["cache"] = (None if cache_size is None
+                         else SubstitutionCache(cache_size))
+    return settings
+
+def _replace_all_chunk(settings, operators):
+    """Do the substitutions of :func:`integrate` for a chunk of operators"""
+    return OpSum(*operators).replace_all(**settings).operators, None
+
+def parallel_replace_all(op_sum, substitutions, max_dim, workers,
+                         cache=None, max_order=None, masses=None):
+    """
+    Compute ``op_sum.replace_all(substitutions, max_dim)`` in a pool
+    of worker processes.
+
+    The sum is split in chunks of consecutive operators and the results
+    are joined in the original order, so that they are equal term by
+    term to those of the serial computation. The substitutions are sent
+    only once to each worker.
+
+    Args:
+        op_sum (OperatorSum): where the substitutions are to be done
+        substitutions (dict): replacement for each field name
+        max_dim (int): maximum dimension of the operators in the result
+        workers (int): number of worker processes
+        cache (``matchingtools.core.SubstitutionCache``): if given, each
+            worker uses its own cache with the same maximum size
+        max_order (int): if given, maximum order in the inverse of the
+            masses of the operators in the result
+        masses (frozenset of strings): names of the mass tensors,
+            required when ``max_order`` is given
+
+    Return:
+        OperatorSum with the result of the substitutions
+    """
+    settings = {"substitutions": substitutions, "max_dim": max_dim,
+                "cache_size": None if cache is None else cache.max_size,
+                "max_order": max_order, "masses": masses}
+    operators, _ = map_chunks(_replace_all_chunk, op_sum.operators, workers,
+                              settings, setup=_worker_settings)
+    return OpSum(*operators)
+
+def integrate(heavy_fields, interaction_lagrangian, max_dim=6, verbose=True,
+              cache=None, workers=None, max_order=None):
     """
     Integrate out heavy fields.
 
@@ -497,21 +935,55 @@ def integrate(heavy_fields, interaction_lagrangian, max_dim=6, verbose=True):
             lagrangian
         verbose (bool): specifies whether to print messages signaling
             the start and end of the integration process.
+        cache (``matchingtools.core.SubstitutionCache``): if given, it
+            is used to reuse the results of the substitutions of the
+            heavy fields for operators with the same canonical form.
+            The results are then equal, up to the order of the tensors
+            and the labels of the contracted indices.
+        workers (int): if greater than 1, the number of processes among
+            which the final substitution of the heavy fields in the
+            lagrangian is split (see :func:`parallel_replace_all`)
+        max_order (int): if given, maximum order in the inverse of the
+            heavy masses of the operators in the effective lagrangian.
+            Terms of higher order are dropped as soon as they appear.
+
+    The propagators of the heavy bosons are expanded as much as needed
+    for ``max_dim`` (see :func:`propagator_expansions`).
     """
     if verbose:
         sys.stdout.write("Integrating... ")
         sys.stdout.flush()
 
-    eoms = dict(concat([field.equations_of_motion(interaction_lagrangian)
-                        for field in heavy_fields]))
-    replaced_eoms = {field_name:
-                     replacement.replace_all(eoms, max_dim - 2)
-                     for field_name, replacement in eoms.items()}
     quadratic_lagrangian = sum([field.quadratic_terms()
                                 for field in heavy_fields],
                                OpSum())
     total_lagrangian = quadratic_lagrangian + interaction_lagrangian
-    result = total_lagrangian.replace_all(replaced_eoms, max_dim)
+
+    field_sources = [field.sources(interaction_lagrangian)
+                     for field in heavy_fields]
+    field_names = [field.eom_names() for field in heavy_fields]
+    heavy_names = set(concat(field_names))
+    source_profiles = dict(
+        (name, dimension_profiles(source.operators, heavy_names))
+        for name, source in concat(field_sources))
+    lagrangian_profiles = dimension_profiles(total_lagrangian.operators,
+                                             heavy_names)
+    expansions = propagator_expansions(heavy_fields, field_names,
+                                       source_profiles, lagrangian_profiles,
+                                       max_dim)
+    eoms = dict(concat([field_equations_of_motion(
+                            field, interaction_lagrangian, expansions, pairs)
+                        for field, pairs in zip(heavy_fields, field_sources)]))
+    masses = (None if max_order is None else
+              frozenset("M" + field.name for field in heavy_fields))
+    replaced_eoms = solve_eoms(eoms, max_dim - 2, cache, max_order, masses)
+    if workers is not None and workers > 1:
+        result = parallel_replace_all(total_lagrangian, replaced_eoms,
+                                      max_dim, workers, cache,
+                                      max_order, masses)
+    else:
+        result = total_lagrangian.replace_all(replaced_eoms, max_dim, cache,
+                                              max_order, masses)
 
     if verbose:
         sys.stdout.write("done.\n")
@@ -529,3 +1001,188 @@ def integrate(heavy_fields, interaction_lagrangian, max_dim=6, verbose=True):
 
 
 
+
+class IntegrationSession(object):
+    """
+    Integrate out heavy fields from a lagrangian built step by step.
+
+    The EOMs of the heavy fields, their solutions, the quadratic terms
+    and the result of the substitution of the heavy fields in each
+    operator are kept from one call of :meth:`effective_lagrangian` to
+    the next. When heavy fields or interaction terms are added, only
+    the following is computed again:
+
+    * the EOMs of the new heavy fields, of those appearing in the new
+      interaction terms and of those needing a different expansion of
+      their propagators (see :func:`propagator_expansions`)
+    * the solutions of the EOMs that depend on them
+      (see :func:`solve_eoms`)
+    * the substitutions in the new operators and in the operators
+      containing a heavy field whose solution has changed
+
+    The effective lagrangian is the same, term by term, as the result
+    of :func:`integrate` for all the heavy fields and interaction terms
+    added, in the same order.
+
+    Attributes:
+        heavy_fields (list of heavy fields): added so far
+        interaction_lagrangian (OperatorSum): sum of the interaction
+            terms added so far
+        max_dim (int): maximum dimension of the operators in the effective
+            lagrangian
+        cache (``matchingtools.core.SubstitutionCache``): optional cache
+            for the substitutions (see :func:`integrate`)
+        max_order (int): if given, maximum order in the inverse of the
+            heavy masses of the operators in the effective lagrangian
+    """
+    def __init__(self, heavy_fields=(), interaction_lagrangian=None,
+                 max_dim=6, cache=None, max_order=None):
+        """
+        Args:
+            heavy_fields (list of heavy fields): to be integrated out
+            interaction_lagrangian (OperatorSum): initial interaction terms
+            max_dim (int): maximum dimension of the operators in the
+                effective lagrangian
+            cache (``matchingtools.core.SubstitutionCache``)
+            max_order (int)
+        """
+        self.heavy_fields = []
+        self.interaction_lagrangian = OpSum()
+        self.max_dim = max_dim
+        self.cache = cache
+        self.max_order = max_order
+        self._field_names = []
+        self._field_sources = []
+        self._stale_fields = set()
+        # Names of the heavy fields for which the dimension profiles
+        # were computed, None when they have to be computed again
+        self._heavy_names = None
+        self._source_profiles = {}
+        self._lagrangian_profiles = set()
+        self._expansions = {}
+        self._eoms = {}
+        self._changed = set()
+        self._solutions = None
+        # Pairs [operator, result of the substitutions or None]
+        self._quadratic_terms = []
+        self._interaction_terms = []
+        self.add_heavy_fields(heavy_fields)
+        if interaction_lagrangian is not None:
+            self.add_interaction_terms(interaction_lagrangian)
+
+    def add_heavy_fields(self, heavy_fields):
+        """
+        Add heavy fields to be integrated out.
+
+        Args:
+            heavy_fields (list of heavy fields)
+        """
+        for field in heavy_fields:
+            self._stale_fields.add(len(self.heavy_fields))
+            self.heavy_fields.append(field)
+            self._field_names.append(field.eom_names())
+            self._field_sources.append(None)
+            self._heavy_names = None
+            self._quadratic_terms.extend(
+                [operator, None]
+                for operator in field.quadratic_terms().operators)
+            if self.max_order is not None:
+                # The order is computed with respect to a new set of masses
+                self._solutions = None
+                for term in self._quadratic_terms + self._interaction_terms:
+                    term[1] = None
+
+    def add_interaction_terms(self, interaction_lagrangian):
+        """
+        Add terms to the interaction lagrangian.
+
+        Args:
+            interaction_lagrangian (OperatorSum)
+        """
+        self.interaction_lagrangian += interaction_lagrangian
+        for index, names in enumerate(self._field_names):
+            if any(interaction_lagrangian.contains(name) for name in names):
+                self._stale_fields.add(index)
+        self._interaction_terms.extend(
+            [operator, None]
+            for operator in interaction_lagrangian.operators)
+        if self._heavy_names is not None:
+            self._lagrangian_profiles |= dimension_profiles(
+                interaction_lagrangian.operators, self._heavy_names)
+
+    def effective_lagrangian(self, verbose=True):
+        """
+        Compute the effective lagrangian for the heavy fields and
+        interaction terms added so far.
+
+        Args:
+            verbose (bool): specifies whether to print messages signaling
+                the start and end of the integration process.
+
+        Return:
+            OperatorSum with the effective lagrangian
+        """
+        if verbose:
+            sys.stdout.write("Integrating... ")
+            sys.stdout.flush()
+
+        for index in self._stale_fields:
+            self._field_sources[index] = self.heavy_fields[index].sources(
+                self.interaction_lagrangian)
+        if self._heavy_names is None:
+            self._heavy_names = set(concat(self._field_names))
+            self._source_profiles = {}
+            self._lagrangian_profiles = dimension_profiles(
+                [term[0] for term in
+                 self._quadratic_terms + self._interaction_terms],
+                self._heavy_names)
+            updated_fields = range(len(self.heavy_fields))
+        else:
+            updated_fields = self._stale_fields
+        for index in updated_fields:
+            for name, source in self._field_sources[index]:
+                self._source_profiles[name] = dimension_profiles(
+                    source.operators, self._heavy_names)
+
+        expansions = propagator_expansions(
+            self.heavy_fields, self._field_names, self._source_profiles,
+            self._lagrangian_profiles, self.max_dim)
+        for index, field in enumerate(self.heavy_fields):
+            if (index in self._stale_fields or
+                expansions.get(field.name) !=
+                self._expansions.get(field.name)):
+                for name, eom in field_equations_of_motion(
+                        field, self.interaction_lagrangian, expansions,
+                        self._field_sources[index]):
+                    self._eoms[name] = eom
+                    self._changed.add(name)
+        self._stale_fields = set()
+        self._expansions = expansions
+
+        masses = (None if self.max_order is None else
+                  frozenset("M" + field.name for field in self.heavy_fields))
+        solutions = solve_eoms(self._eoms, self.max_dim - 2, self.cache,
+                               self.max_order, masses,
+                               self._solutions, self._changed)
+        updated = set(name for name in solutions
+                      if self._solutions is None or
+                      self._solutions.get(name) is not solutions[name])
+        self._solutions = solutions
+        self._changed = set()
+
+        terms = self._quadratic_terms + self._interaction_terms
+        recomputed = 0
+        for term in terms:
+            operator = term[0]
+            if term[1] is None or any(tensor.name in updated
+                                      for tensor in operator.tensors):
+                term[1] = OpSum(operator).replace_all(
+                    solutions, self.max_dim, self.cache,
+                    self.max_order, masses).operators
+                recomputed += 1
+
+        if verbose:
+            sys.stdout.write("done ({} of {} operators recomputed).\n".format(
+                recomputed, len(terms)))
+
+        return OpSum(*concat([term[1] for term in terms]))
@@ -13,7 +13,6 @@ from matchingtools.transformations import collect, sum_numbers
 from fractions import Fraction
 from matchingtools.lsttools import concat
 from subprocess import call
-import copy
 
 def display_tensor_aux(structure, indices, num_of_der):
     for _ in range(num_of_der):
@@ -162,14 +161,12 @@ def collect_conjugates(coef, conjugates):
     def convert_tensor(tensor):
         if tensor.name == "$i":
             return tensor
-        new_tensor = copy.copy(tensor)
-        new_tensor.name = conjugates[tensor.name]
-        return new_tensor
+        return tensor.change_name(conjugates[tensor.name])
 
     rest_ops = coef
     while len(rest_ops) > 0:
         op, num = rest_ops[0]
-        opc = Operator(map(convert_tensor, op.tensors))
+        opc = Operator(list(map(convert_tensor, op.tensors)))
         for i, (other, other_num) in enumerate(rest_ops[1:]):
             if ((other == opc and other_num == num) or
                 (other == -opc and other_num == -num)):
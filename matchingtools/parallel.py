@@ -0,0 +1,64 @@
+"""
+Module with the process pool used by :func:`matchingtools.integration.integrate`
+and :func:`matchingtools.transformations.apply_rules` to split the
+operators of a sum among several processes.
+"""
+
+import multiprocessing
+
+from matchingtools.core import eager_normalization, set_eager_normalization
+from matchingtools.lsttools import concat
+
+_worker_state = {}
+
+def _init_worker(chunk_function, setup, payload, eager):
+    """Keep the data shared by all the chunks sent to a worker process"""
+    set_eager_normalization(eager)
+    _worker_state["chunk_function"] = chunk_function
+    _worker_state["data"] = payload if setup is None else setup(payload)
+
+def _run_chunk(operators):
+    """Apply the function given to the worker process to a chunk"""
+    return _worker_state["chunk_function"](_worker_state["data"], operators)
+
+def map_chunks(chunk_function, operators, workers, payload, setup=None,
+               chunks_per_worker=4):
+    """
+    Process a list of operators in chunks in a pool of worker processes.
+
+    The operators are split in chunks of consecutive operators, which
+    are handed to the processes as they become free. The payload is sent
+    only once to each process, together with the eager normalization mode
+    (see :func:`matchingtools.core.set_eager_normalization`).
+
+    Args:
+        chunk_function (function): module-level function that takes the
+            data of the worker and a list of operators and returns a pair
+            with the list of resulting operators and any other information
+        operators (list of Operator): to be processed
+        workers (int): number of worker processes
+        payload: data shared by all the chunks
+        setup (function): if given, it is called in each worker process
+            with the payload, and its result is the data passed to
+            ``chunk_function`` instead of the payload
+        chunks_per_worker (int): approximate number of chunks for each
+            worker process
+
+    Return:
+        A pair with the list of the resulting operators, in the order of
+        the chunks, and the list of the other information returned for
+        each chunk
+    """
+    chunk_size = max(1, -(-len(operators) // (chunks_per_worker * workers)))
+    chunks = [operators[i:i + chunk_size]
+              for i in range(0, len(operators), chunk_size)]
+    pool = multiprocessing.Pool(
+        workers, initializer=_init_worker,
+        initargs=(chunk_function, setup, payload, eager_normalization()))
+    try:
+        results = list(pool.imap(_run_chunk, chunks))
+    finally:
+        pool.close()
+        pool.join()
+    return (concat([chunk_operators for chunk_operators, _ in results]),
+            [info for _, info in results])
@@ -10,3 +10,46 @@ def tuple_permutations(tpl):
 
 def permutations(n):
     return tuple_permutations(tuple(range(n)))
+
+_sign_cache = {}
+_max_sign_cache_size = 100000
+
+def permutation_sign(permutation):
+    """
+    Compute the sign of a permutation of ``range(n)`` by decomposing it
+    into cycles. The results are cached for repeated permutations.
+
+    Args:
+        permutation (tuple of ints): the images of 0, 1, ..., n - 1
+
+    Return:
+        1 for even permutations and -1 for odd ones
+    """
+    sign = _sign_cache.get(permutation)
+    if sign is not None:
+        return sign
+    visited = [False] * len(permutation)
+    transpositions = 0
+    for start in range(len(permutation)):
+        length = 0
+        pos = start
+        while not visited[pos]:
+            visited[pos] = True
+            pos = permutation[pos]
+            length += 1
+        if length > 0:
+            transpositions += length - 1
+    sign = -1 if transpositions % 2 else 1
+    if len(_sign_cache) >= _max_sign_cache_size:
+        _sign_cache.clear()
+    _sign_cache[permutation] = sign
+    return sign
+
+def reordering_sign(sequence):
+    """
+    Compute the sign of the permutation that sorts a sequence of
+    distinct elements (for example, the original positions of some
+    fermions in the order in which they appear after a reordering).
+    """
+    return permutation_sign(tuple(sorted(range(len(sequence)),
+                                         key=sequence.__getitem__)))
@@ -12,76 +12,23 @@ coefficients of each operator in a given list.
 
 import sys
 import copy
+import bisect
+from fractions import Fraction
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from matchingtools.core import (
-    Operator, OperatorSum, Op, OpSum, Tensor, i_op,
-    number_op, power_op, tensor_op, kdelta, generic)
+    Operator, OperatorSum, OpSum, Tensor, Pattern,
+    number_op, tensor_op, kdelta, generic,
+    match_tensor_lists, increase_and_bind_indices, apply_derivatives,
+    collect_numbers, collect_powers, normalize, eager_normalization)
 
 from matchingtools.lsttools import concat
 
-def collect_numbers(operator):
-    """
-    Collect all the tensors representing numbers into a single one.
-
-    A tensor is understood to represent a number when its name
-    is ``"$number"`` or ``$i``.
-    """
-    new_tensors = []
-    number = 1
-    i_count = 0
-    is_complex = False
-    for tensor in operator.tensors:
-        if tensor.name == "$number":
-            if tensor.content.imag != 0:
-                is_complex = True
-            number *= tensor.content
-        elif tensor.name == "$i":
-            i_count += 1
-        else:
-            new_tensors.append(tensor)
-
-    result = Operator(new_tensors)
-    
-    if is_complex:
-        number *= {0: 1, 1: 1j, 2: -1, 3: -1j}[i_count % 4]
-    else:
-        number, result = {
-            0: (number, result),
-            1: (number, i_op * result),
-            2: (-number, result),
-            3: (-number, i_op * result)}[i_count % 4]
-            
-    # Remove coefficients 1
-    if number == 1:
-        return result
-    
-    return number_op(number) * result
-
-def collect_powers(operator):
-    """
-    Collect all the tensors that are equal and return the correspondin
-    powers.
-    """
-    new_tensors = []
-    symbols = {}
-    for tensor in operator.tensors:
-        if tensor.is_field or tensor.name[0] == "$" or tensor.exponent is None:
-            new_tensors.append(tensor)
-        else:
-            # Previusly collected exponent for same base and indices
-            prev_exponent = symbols.get((tensor.name, tuple(tensor.indices)), 0)
-            
-            # The exponents of a product are added
-            symbols[(tensor.name, tuple(tensor.indices))] = (
-                tensor.exponent + prev_exponent)
-
-    # Remove tensors with exponent 0
-    new_op = Operator([])
-    for (name, inds), exponent in symbols.items():
-        if exponent != 0:
-            new_op *= power_op(name, exponent, indices=inds)
-            
-    return new_op * Op(*new_tensors)
+from matchingtools.parallel import map_chunks
 
 def collect_numbers_and_powers(op_sum):
     """
@@ -103,85 +50,440 @@ def remove_kdeltas(operator):
             return remove_kdeltas(new_op.operators[0])
     return operator
 
+def feature_counts(tensors):
+    """
+    Count the tensors with each pair ``(name, num_of_der)``.
+
+    A pattern can only be found inside an operator when the operator
+    has at least as many tensors as the pattern for every such pair.
+    """
+    counts = {}
+    for tensor in tensors:
+        feature = (tensor.name, tensor.num_of_der)
+        counts[feature] = counts.get(feature, 0) + 1
+    return counts
+
+class Rule(object):
+    """
+    Compiled rule for the substitution of a pattern by a replacement.
+
+    The pattern is compiled into a :class:`matchingtools.core.Pattern`
+    and the replacement into a template of tensors, ready to have
+    their indices bound to those of the matched operator. Tensors
+    without indices are shared by all the results.
+
+    Attributes:
+        pattern (Pattern): compiled pattern
+        replacement (OperatorSum): the replacement
+        template (list of lists of pairs (Tensor, bool)): for each
+            operator in the replacement, its tensors together with
+            whether they have indices
+        requirements (dict): the :func:`feature_counts` of the pattern
+    """
+    def __init__(self, pattern, replacement):
+        if not isinstance(pattern, Pattern):
+            pattern = Pattern(pattern)
+        self.pattern = pattern
+        self.replacement = replacement
+        self.template = [[(tensor, bool(tensor.indices))
+                          for tensor in operator.tensors]
+                         for operator in replacement.operators]
+        self.requirements = feature_counts(pattern.tensors)
+
+    def apply(self, operator):
+        """
+        Replace the first occurrence of the pattern by the replacement
+        in operator. Equivalent to :func:`apply_rule`.
+
+        Return:
+            an OperatorSum if the pattern is found, None otherwise
+        """
+        pattern = self.pattern
+        matches = match_tensor_lists(operator.tensors, pattern,
+                                     operator.symmetries, operator.positions())
+        for match, free_indices in matches:
+            rest = [operator.tensors[pos] for pos in match[len(pattern):]]
+            if operator.fermion_sign(match, pattern) == -1:
+                rest.append(number_op(-1).tensors[0])
+
+            # Contracted indices of the replacement come after all others
+            indices = free_indices + [index for tensor in rest
+                                      for index in tensor.indices]
+            incr = (max(indices) if indices else 0) + 1
+            operators = [
+                Operator([tensor.change_indices(increase_and_bind_indices(
+                              tensor.indices, incr, free_indices))
+                          if has_indices else tensor
+                          for tensor, has_indices in tensors] + rest)
+                for tensors in self.template]
+            if eager_normalization():
+                operators = [normalize(op) for op in operators]
+            return OperatorSum(operators)
+        return None
+
+_compiled_rules = {}
+_max_compiled_rules = 10000
+
+def compile_rule(pattern, replacement):
+    """
+    Return the compiled :class:`Rule` for a pattern and a replacement.
+
+    Compiled rules are cached for the whole process, so that a given
+    pair of objects is only compiled once. The pattern may be an
+    Operator or an already compiled :class:`matchingtools.core.Pattern`,
+    which is used as it is.
+
+    The cache keeps a reference to the objects of each pair, so that
+    their ids are not reused by other objects while they are in it.
+    """
+    key = (id(pattern), id(replacement))
+    entry = _compiled_rules.get(key)
+    if (entry is not None and entry[0] is pattern and
+        entry[1] is replacement):
+        return entry[2]
+    if len(_compiled_rules) >= _max_compiled_rules:
+        _compiled_rules.clear()
+    rule = Rule(pattern, replacement)
+    _compiled_rules[key] = (pattern, replacement, rule)
+    return rule
+
+def compile_rules(rules):
+    """
+    Compile a list of rules given as pairs ``(pattern, replacement)``
+    (see :func:`apply_rules`). Elements that are already compiled
+    :class:`Rule` objects are kept.
+    """
+    return [rule if isinstance(rule, Rule) else compile_rule(*rule)
+            for rule in rules]
+
 def apply_rule(operator, pattern, replacement):
     """
     Replace the first occurrence of ``pattern`` by ``replacement``
     in ``operator``
     """
-    new_op = operator.match_first(pattern)
-    if new_op is None:
-        return None
-    return new_op.replace_first("generic", replacement)
+    return compile_rule(pattern, replacement).apply(operator)
 
-def apply_rules_aux(op_sum, rules):
+class RuleIndex(object):
     """
-    Auxiliary function for :func:`apply_rules`. 
+    Index of compiled rules by the names of the tensors in their
+    patterns, so that each operator only tries the rules whose
+    patterns it can possibly contain.
+
+    Each rule is keyed on the rarest name in its pattern, measured
+    by the number of operators of a sum in which the name appears.
+    An operator collects the rules keyed on the names it contains
+    and keeps those whose requirements (see :func:`feature_counts`)
+    it covers.
+
+    Many operators can also be screened at once with :meth:`screen`,
+    which uses NumPy when it is available.
+
+    Attributes:
+        rules (list of Rule): the indexed rules
+        by_name (dict): for each name, the numbers of the rules
+            keyed on it
+        unkeyed (list of int): numbers of the rules with empty
+            patterns, which are candidates for every operator
+        features (dict): column assigned to each pair
+            ``(name, num_of_der)`` required by some rule
+        attempts (int): number of match attempts done
+        skipped (int): number of match attempts avoided
+    """
+    def __init__(self, rules, op_sum=None):
+        self.rules = compile_rules(rules)
+        frequencies = {}
+        if op_sum is not None:
+            for operator in op_sum.operators:
+                for name in operator.positions():
+                    frequencies[name] = frequencies.get(name, 0) + 1
+        self.by_name = {}
+        self.unkeyed = []
+        self.features = {}
+        for number, rule in enumerate(self.rules):
+            for feature in sorted(rule.requirements):
+                self.features.setdefault(feature, len(self.features))
+            names = rule.pattern.name_counts
+            if not names:
+                self.unkeyed.append(number)
+                continue
+            key = min(names, key=lambda name: (frequencies.get(name, 0), name))
+            self.by_name.setdefault(key, []).append(number)
+        self.attempts = 0
+        self.skipped = 0
+
+    def __len__(self):
+        return len(self.rules)
+
+    def candidates(self, operator):
+        """
+        Return the sorted numbers of the rules that may apply to
+        ``operator``.
+        """
+        counts = feature_counts(operator.tensors)
+        numbers = set(self.unkeyed)
+        for name in operator.positions():
+            numbers.update(self.by_name.get(name, ()))
+        return sorted(
+            number for number in numbers
+            if all(counts.get(feature, 0) >= count
+                   for feature, count
+                   in self.rules[number].requirements.items()))
+
+    def screen(self, operators):
+        """
+        Find the rules that may apply to each of a list of operators.
+
+        The operators are encoded as a matrix with the counts of each
+        of the :attr:`features` in each row, and every rule is compared
+        with all the rows at once. Without NumPy, :meth:`candidates`
+        is used for each operator.
+
+        Return:
+            list with the result of :meth:`candidates` for each operator
+        """
+        if numpy is None or not operators or not self.features:
+            return [self.candidates(operator) for operator in operators]
+        features = self.features
+        rows = []
+        for operator in operators:
+            row = [0] * len(features)
+            for tensor in operator.tensors:
+                column = features.get((tensor.name, tensor.num_of_der))
+                if column is not None:
+                    row[column] += 1
+            rows.append(row)
+        matrix = numpy.array(rows)
+        result = [[] for _ in operators]
+        for number, rule in enumerate(self.rules):
+            if not rule.requirements:
+                selected = range(len(operators))
+            else:
+                columns = [features[feature] for feature in rule.requirements]
+                required = [rule.requirements[feature]
+                            for feature in rule.requirements]
+                selected = numpy.flatnonzero(
+                    (matrix[:, columns] >= required).all(axis=1))
+            for row in selected:
+                result[row].append(number)
+        return result
 
-    Do the actual computations for each iteration.
+def apply_rules_to_operator(operator, index, candidates=None):
     """
-    for pattern, replacement in rules:
-        new_op_sum = OperatorSum()
-        for operator in op_sum.operators:
-            operator = remove_kdeltas(operator)
-            new_ops = apply_rule(operator, pattern, replacement)
+    Apply once each of the rules in a :class:`RuleIndex` to an
+    operator and to the operators resulting from it.
+
+    The numbers of the rules that may apply to the operator itself
+    can be given in ``candidates`` (see :meth:`RuleIndex.screen`).
+
+    Return:
+        a pair (list of operators, bool) with the resulting operators
+        and whether any rule was applied
+    """
+    num_of_rules = len(index)
+    new_operators = []
+    changed = False
+    # Pairs (operator, number of the next rule to be tried)
+    pending = [(operator, 0)]
+    while pending:
+        operator, start = pending.pop()
+        if start == num_of_rules:
+            new_operators.append(operator)
+            continue
+        # Removing the deltas never makes more rules applicable, so
+        # the given candidates are still valid afterwards
+        operator = remove_kdeltas(operator)
+        if start > 0 or candidates is None:
+            candidates = index.candidates(operator)
+        new_ops = None
+        attempts = 0
+        for number in candidates[bisect.bisect_left(candidates, start):]:
+            attempts += 1
+            new_ops = index.rules[number].apply(operator)
             if new_ops is not None:
-                new_op_sum += new_ops
-            else:
-                new_op_sum += OperatorSum([operator])
-        op_sum = new_op_sum
-    return new_op_sum
+                break
+        index.attempts += attempts
+        if new_ops is None:
+            index.skipped += num_of_rules - start - attempts
+            new_operators.append(operator)
+        else:
+            index.skipped += number - start + 1 - attempts
+            changed = True
+            pending.extend((new_op, number + 1)
+                           for new_op in reversed(new_ops.operators))
+    return new_operators, changed
+
+def apply_rules_aux(op_sum, rules, index=None):
+    """
+    Auxiliary function for :func:`apply_rules`. 
+
+    Do the actual computations for each iteration. Every operator
+    goes through the rules in order, but only those given by a
+    :class:`RuleIndex` are actually tried.
+    """
+    if index is None:
+        index = RuleIndex(rules, op_sum)
+    new_operators = []
+    screening = index.screen(op_sum.operators)
+    for operator, candidates in zip(op_sum.operators, screening):
+        new_operators += apply_rules_to_operator(
+            operator, index, candidates)[0]
+    return OperatorSum(new_operators)
+
+def iterate_rules(operators, index, max_iterations, progress=None):
+    """
+    Auxiliary function for :func:`apply_rules`.
+
+    Do the iterations of the application of the rules in a
+    :class:`RuleIndex` to a list of operators, submitting to each
+    iteration only the operators produced in the previous one.
+
+    Args:
+        operators (list of Operator): to which the rules are applied
+        index (RuleIndex): the rules
+        max_iterations (int): maximum number of iterations
+        progress (function): if given, it is called with the number
+            of each iteration before doing it
+
+    Return:
+        A pair (list of operators, bool) with the result and whether
+        some operators would still be changed by a further iteration
+    """
+    # Pairs (operator, whether it has to be submitted to the rules)
+    entries = [(operator, True) for operator in operators]
+    iteration = 0
+    while iteration < max_iterations and any(
+            pending for _, pending in entries):
+        iteration += 1
+        if progress is not None:
+            progress(iteration)
+
+        screening = iter(index.screen(
+            [operator for operator, pending in entries if pending]))
+        new_entries = []
+        for operator, pending in entries:
+            if not pending:
+                new_entries.append((operator, False))
+                continue
+            new_operators, changed = apply_rules_to_operator(
+                operator, index, next(screening))
+            new_entries.extend((new_operator, changed)
+                               for new_operator in new_operators)
+        entries = new_entries
+
+    return ([operator for operator, _ in entries],
+            any(pending for _, pending in entries))
+
+def _apply_rules_chunk(settings, operators):
+    """
+    Do the iterations of :func:`apply_rules` for a chunk of operators.
 
-def apply_rules(op_sum, rules, max_iterations, verbose=True):
+    Return:
+        A pair with the resulting operators and a tuple with whether
+        some of them would still be changed by a further iteration and
+        the numbers of match attempts done and skipped
+    """
+    index = settings["index"]
+    attempts, skipped = index.attempts, index.skipped
+    new_operators, unfinished = iterate_rules(
+        operators, index, settings["max_iterations"])
+    return (new_operators,
+            (unfinished, index.attempts - attempts, index.skipped - skipped))
+
+def apply_rules(op_sum, rules, max_iterations, verbose=True, workers=None):
     """
     Apply all the given rules to the operator sum.
 
     With the adecuate set of rules this function can be used to express
     an effective lagrangian in a specific basis of operators
 
+    Only the operators produced by the application of some rule in
+    an iteration are submitted to the next one: an operator to which
+    no rule applies is left unchanged by any further iteration.
+    The process stops as soon as an iteration changes nothing, so
+    ``max_iterations`` is only a safety limit: a large one costs no
+    more than the iterations that are actually needed.
+
     Args:
         op_sum (:class:`matchingtools.operator.OperatorSum`): to which the rules
             should be applied.
         rules (list of pairs (:class:`matchingtools.operators.Operator`,  :class:`matchingtools.operators.OperatorSum`)): The first element
             of each pair represents a pattern to be subtituted in each
             operator by the second element using :func:`apply_rule`.
+            Already compiled :class:`Rule` objects are also accepted;
+            pairs are compiled once per process (see :func:`compile_rules`)
+            and indexed by the names in their patterns (see
+            :class:`RuleIndex`).
         max_iterations (int): maximum number of application of rules to
-            each operator.
+            each operator
         verbose (bool): specifies whether to print messages signaling
-            the start and end of the integration process
+            the start and end of the integration process, and whether
+            ``max_iterations`` was reached before an iteration changed
+            nothing
+        workers (int): if greater than 1, the number of processes among
+            which the operators are split. The rules are sent once to
+            each process and small chunks of operators are handed to
+            the processes as they become free. The results are joined
+            in the original order, so that they are the same as those
+            of the serial computation.
 
     Return:
         OperatorSum containing the result of the application of rules.
     """
-    
-    for i in range(0, max_iterations):
+    index = RuleIndex(rules, op_sum)
+
+    if workers is not None and workers > 1:
         if verbose:
             sys.stdout.write(
-                "\rApplying rules (iteration " +
-                str(i + 1) + "/" + str(max_iterations) + ")")
+                "\rApplying rules (" + str(workers) + " workers)")
             sys.stdout.flush()
-
-        op_sum =  apply_rules_aux(op_sum, rules)
+        settings = {"index": index, "max_iterations": max_iterations}
+        new_operators, results = map_chunks(
+            _apply_rules_chunk, op_sum.operators, workers, settings,
+            chunks_per_worker=16)
+        unfinished = False
+        for chunk_unfinished, attempts, skipped in results:
+            unfinished = unfinished or chunk_unfinished
+            index.attempts += attempts
+            index.skipped += skipped
+    else:
+        def progress(iteration):
+            if verbose:
+                sys.stdout.write(
+                    "\rApplying rules (iteration " +
+                    str(iteration) + "/" + str(max_iterations) + ")")
+                sys.stdout.flush()
+        new_operators, unfinished = iterate_rules(
+            op_sum.operators, index, max_iterations, progress)
 
     if verbose:
-        sys.stdout.write("\rApplying rules... done.          \n")
+        if unfinished:
+            sys.stdout.write(
+                "\rApplying rules... stopped after " + str(max_iterations) +
+                " iterations without reaching a fixpoint.\n")
+        else:
+            sys.stdout.write(
+                "\rApplying rules... done (" + str(index.skipped) + " of " +
+                str(index.attempts + index.skipped) +
+                " match attempts skipped).\n")
         sys.stdout.flush()
         
-    return op_sum
-
+    return OperatorSum(new_operators)
 
 def sum_numbers(op_sum):
     """
     Collect operators that are equal except for a numeric coefficient
     and sum the numbers to get one.
+
+    Equal operators are found through their canonical form (see
+    :meth:`matchingtools.core.Operator.canonical_form`), so that all
+    the terms are combined in a single pass.
     """
     collection = []
+    positions = {}
     for op in op_sum.operators:
         # Strip numeric coefficient off
-        collected = False
-        num = 1
-        n_removed = 0
         op = collect_numbers(op)
-        if op.tensors[0].name == "$number":
+        if op.tensors and op.tensors[0].name == "$number":
             num = op.tensors[0].content
             new_op = Operator(op.tensors[1:])
         else:
@@ -189,15 +491,201 @@ def sum_numbers(op_sum):
             new_op = op
 
         # Sum the numbers of equal operators
-        for i, (collected_op, collected_num) in enumerate(collection):
-            if collected_op == new_op:
-                collected = True
-                collection[i] = (new_op, num + collected_num)
-                break
-        if not collected:
+        pos = positions.get(new_op)
+        if pos is None:
+            positions[new_op] = len(collection)
             collection.append((new_op, num))
+        else:
+            collection[pos] = (new_op, num + collection[pos][1])
     return [(o, num) for o, num in collection if abs(num) > 10**(-10)]
 
+def _add_terms(vector, operators, representatives, keys):
+    """
+    Add the operators to a vector of coefficients.
+
+    The vector is a dictionary with the canonical keys (see
+    :meth:`matchingtools.core.Operator.canonical_form`) of the operators
+    as keys and their coefficients as values. The coefficients are
+    relative to the first operator found with each key, which is kept
+    in the dictionary ``representatives`` together with its sign. The
+    new keys are appended to the list ``keys``.
+    """
+    for op in operators:
+        # Strip numeric coefficient off
+        op = collect_numbers(op)
+        if op.tensors and op.tensors[0].name == "$number":
+            num = op.tensors[0].content
+            op = Operator(op.tensors[1:])
+        else:
+            num = 1
+        key, sign, _ = op.canonical_form()
+        if sign == 0:
+            continue
+        if key not in representatives:
+            representatives[key] = (op, sign)
+            keys.append(key)
+        num *= sign * representatives[key][1]
+        vector[key] = vector.get(key, 0) + num
+
+def _parents(operator):
+    """
+    Find the operators whose total derivatives contain an operator.
+
+    For each field of the operator with derivatives, the outermost
+    one is removed. Applying it to the whole resulting operator gives
+    a total derivative with one term equal to the original operator.
+
+    Return:
+        A list of pairs with each resulting operator and the index
+        of the derivative removed from it
+    """
+    result = []
+    for pos, tensor in enumerate(operator.tensors):
+        if tensor.num_of_der == 0:
+            continue
+        parent = Tensor(
+            tensor.name, tensor.indices[1:], is_field=True,
+            num_of_der=tensor.num_of_der - 1,
+            dimension=tensor.dimension, statistics=tensor.statistics)
+        tensors = list(operator.tensors)
+        tensors[pos] = parent
+        result.append((Operator(tensors), tensor.indices[0]))
+    return result
+
+def _derivative_profile(operator):
+    """
+    Numbers of derivatives acting on each field of an operator,
+    from the largest to the smallest.
+    """
+    return tuple(sorted((tensor.num_of_der for tensor in operator.tensors
+                         if tensor.is_field), reverse=True))
+
+def _reduce(vector, pivots, rank):
+    """
+    Eliminate from a vector the keys of the given pivots.
+
+    The pivot with key ``k`` is a vector whose coefficient of ``k`` is 1
+    and all whose other keys have lower rank. Eliminating the keys from
+    the highest to the lowest rank, each subtraction only introduces keys
+    that come later.
+    """
+    while True:
+        pending = [key for key in vector if key in pivots]
+        if not pending:
+            return
+        key = max(pending, key=rank)
+        num = vector.pop(key)
+        for other, other_num in pivots[key].items():
+            if other != key:
+                vector[other] = vector.get(other, 0) - num * other_num
+                if vector[other] == 0:
+                    del vector[other]
+
+def integrate_by_parts(op_sum, verbose=True):
+    """
+    Reduce an operator sum using integration by parts.
+
+    The operators are written in a canonical form modulo total
+    derivatives. The operators with the same tensors and the same total
+    number of derivatives are related by the total derivatives obtained
+    from them by removing a derivative from one field and applying it
+    to the whole operator, until no new operators appear. These
+    relations are used to eliminate the operators with more derivatives
+    acting on the same field, such as :math:`\\phi^\\dagger D^2\\phi`,
+    in favour of those with the derivatives spread among the fields.
+    Total derivatives are thus dropped, and the terms that only differ
+    by them are combined.
+
+    The operators without derivatives are left as they are, without
+    even computing their canonical forms.
+
+    Using it before :func:`apply_rules` reduces the number of operators
+    to which the rules have to be applied.
+
+    Args:
+        op_sum (OperatorSum): to be reduced
+        verbose (bool): specifies whether to print messages signaling
+            the start and end of the process, with the number of terms
+            with derivatives eliminated from those that remain after
+            summing the equal ones (as in :func:`sum_numbers`)
+
+    Return:
+        OperatorSum with the operators without derivatives followed by
+        the reduced terms, each of these with a single numeric coefficient
+    """
+    if verbose:
+        sys.stdout.write("Integrating by parts... ")
+        sys.stdout.flush()
+
+    without_derivatives = []
+    with_derivatives = []
+    for op in op_sum.operators:
+        if any(tensor.num_of_der > 0 for tensor in op.tensors):
+            with_derivatives.append(op)
+        else:
+            without_derivatives.append(op)
+
+    vector = {}
+    representatives = {}
+    keys = []
+    _add_terms(vector, with_derivatives, representatives, keys)
+    num_of_terms = len([key for key in keys if abs(vector[key]) > 10**(-10)])
+
+    classes = {}
+    for key in keys:
+        op = representatives[key][0]
+        num_of_der = sum(tensor.num_of_der for tensor in op.tensors)
+        names = tuple(sorted(tensor.name for tensor in op.tensors))
+        classes.setdefault((num_of_der, names), []).append(key)
+
+    def rank(key):
+        op = representatives[key][0]
+        return (_derivative_profile(op), key)
+
+    for class_keys in classes.values():
+        # Relations among the operators of the class, given by the
+        # total derivatives of distinct parents
+        pivots = {}
+        pending = list(class_keys)
+        seen = set(class_keys)
+        parents = set()
+        while pending:
+            op = representatives[pending.pop()][0]
+            for parent, index in _parents(op):
+                parent_key, parent_sign, _ = parent.canonical_form()
+                if parent_sign == 0 or parent_key in parents:
+                    continue
+                parents.add(parent_key)
+                relation = {}
+                _add_terms(relation,
+                           apply_derivatives([index], parent).operators,
+                           representatives, keys)
+                for key in relation:
+                    if key not in seen:
+                        seen.add(key)
+                        pending.append(key)
+                _reduce(relation, pivots, rank)
+                relation = {key: num for key, num in relation.items()
+                            if num != 0}
+                if relation:
+                    pivot = max(relation, key=rank)
+                    num = Fraction(relation[pivot])
+                    pivots[pivot] = {key: other_num / num
+                                     for key, other_num in relation.items()}
+        _reduce(vector, pivots, rank)
+
+    reduced = [number_op(vector[key]) * representatives[key][0]
+               for key in keys
+               if key in vector and abs(vector[key]) > 10**(-10)]
+
+    if verbose:
+        sys.stdout.write(
+            "done (" + str(num_of_terms - len(reduced)) + " of " +
+            str(num_of_terms) + " terms with derivatives eliminated).\n")
+        sys.stdout.flush()
+
+    return OperatorSum(without_derivatives + reduced)
+
 def collect_by_tensors(op_sum, tensor_names):
     """
     Collect the coefficients of the given tensors.
@@ -0,0 +1,88 @@
+import unittest
+
+from matchingtools.core import (
+    TensorBuilder, FieldBuilder, Op, OpSum, D, boson, fermion,
+    SubstitutionCache, generic)
+from matchingtools.transformations import sum_numbers
+
+c = TensorBuilder("c")
+d = TensorBuilder("d")
+g = TensorBuilder("g")
+k = TensorBuilder("k")
+s = TensorBuilder("s")
+phi = FieldBuilder("phi", 1, boson)
+phic = FieldBuilder("phic", 1, boson)
+X = FieldBuilder("X", 1, boson)
+psi = FieldBuilder("psi", 1.5, fermion)
+chi = FieldBuilder("chi", 1.5, fermion)
+
+
+class TestCanonicalForm(unittest.TestCase):
+    def test_reordered_and_relabelled(self):
+        op = Op(c(0, 1), phic(0), phi(1), phic(2), phi(2))
+        other = Op(phi(7), phic(5), phic(3), c(3, 7), phi(5))
+        self.assertEqual(op, other)
+        self.assertEqual(hash(op), hash(other))
+
+    def test_different_contractions(self):
+        op = Op(c(0, 1), phic(0), phi(1), phic(2), phi(2))
+        other = Op(c(0, 1), phic(1), phi(0), phic(2), phi(2))
+        self.assertNotEqual(op, other)
+
+    def test_fermion_sign(self):
+        op = Op(c(0, 1), psi(0), chi(1))
+        other = Op(chi(1), c(0, 1), psi(0))
+        key, sign, _ = op.canonical_form()
+        other_key, other_sign, _ = other.canonical_form()
+        self.assertEqual(key, other_key)
+        self.assertEqual(sign, -other_sign)
+        self.assertNotEqual(op, other)
+
+    def test_vanishing_sign(self):
+        self.assertEqual(Op(d(0), psi(0), d(1), psi(1)).canonical_form()[1], 0)
+        self.assertNotEqual(
+            Op(d(0), phi(0), d(1), phi(1)).canonical_form()[1], 0)
+
+
+class TestMatch(unittest.TestCase):
+    def test_contractions(self):
+        op = Op(c(3, 1), phic(1), phi(2), phic(2), phi(3))
+        self.assertIsNone(op.match_first(Op(c(0, 1), phic(0), phi(1))))
+        match = op.match_first(Op(c(0, 1), phic(1), phi(0)))
+        self.assertEqual(match, Op(generic(), phi(0), phic(0)))
+
+    def test_free_indices(self):
+        op = Op(c(3, 1), phic(1), phi(2), phic(2), phi(3))
+        match = op.match_first(Op(phic(-1), phi(-2)))
+        self.assertIsNotNone(match)
+        self.assertEqual(len(match.tensors), 4)
+
+    def test_interchangeable_tensors(self):
+        op = Op(d(0), d(1), phi(0), phi(1), phic(2), c(2, 3), phic(3))
+        match = op.match_first(Op(phic(0), c(0, 1), phic(1)))
+        self.assertIsNotNone(match)
+        self.assertIsNone(op.match_first(Op(phic(0), c(0, 1), phi(1))))
+
+
+class TestSubstitutionCache(unittest.TestCase):
+    def test_replace_first_same_occurrence(self):
+        op = Op(phic(1), X(2), s(1, 2), k(0), X(0), phi(3), phic(3))
+        replacement = OpSum(Op(g(), phic(-1), D(4, phi(4))),
+                            Op(g(), D(5, phic(5)), phi(-1)),
+                            Op(k(-1)))
+        result = op.replace_first("X", replacement)
+        cached = op.replace_first("X", replacement,
+                                  cache=SubstitutionCache())
+        self.assertEqual(sum_numbers(result + (-cached)), [])
+
+    def test_hits(self):
+        cache = SubstitutionCache()
+        substitutions = {"X": OpSum(Op(c(-1, 0), phi(0)))}
+        first = Op(phic(0), X(0)).replace_all(substitutions, 4, cache)
+        second = Op(X(5), phic(5)).replace_all(substitutions, 4, cache)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(sum_numbers(first + (-second)), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+
+from matchingtools.core import (
+    TensorBuilder, FieldBuilder, Op, OpSum, boson, inverse_mass_order)
+from matchingtools.integration import (
+    RealScalar, integrate, solve_eoms, eoms_dependency_groups)
+from matchingtools.transformations import sum_numbers
+
+sigma = TensorBuilder("sigma")
+kappa = TensorBuilder("kappa")
+lamb = TensorBuilder("lamb")
+
+phi = FieldBuilder("phi", 1, boson)
+phic = FieldBuilder("phic", 1, boson)
+Xi = FieldBuilder("Xi", 1, boson)
+
+interaction_lagrangian = -OpSum(
+    Op(kappa(), Xi(0), phic(1), sigma(0, 1, 2), phi(2)),
+    Op(lamb(), Xi(0), Xi(0), phic(1), phi(1)))
+
+heavy_Xi = RealScalar("Xi", 1, has_flavor=False)
+
+c = TensorBuilder("c")
+d = TensorBuilder("d")
+A = FieldBuilder("A", 1, boson)
+B = FieldBuilder("B", 1, boson)
+C = FieldBuilder("C", 1, boson)
+
+# B and C depend on each other and A depends on them
+eoms = {"A": OpSum(Op(c(), B(), phi())),
+        "B": OpSum(Op(c(), C(), phi()), Op(c(), phi(), phi())),
+        "C": OpSum(Op(d(), B(), phi()), Op(d(), phi(), phi()))}
+
+
+class TestIntegrate(unittest.TestCase):
+    def test_workers(self):
+        serial = integrate([heavy_Xi], interaction_lagrangian, 8,
+                           verbose=False)
+        parallel = integrate([heavy_Xi], interaction_lagrangian, 8,
+                             verbose=False, workers=2)
+        self.assertEqual(list(map(str, parallel.operators)),
+                         list(map(str, serial.operators)))
+
+
+    def test_max_order(self):
+        full = integrate([heavy_Xi], interaction_lagrangian, 8,
+                         verbose=False)
+        for max_order in [2, 4]:
+            truncated = integrate([heavy_Xi], interaction_lagrangian, 8,
+                                  verbose=False, max_order=max_order)
+            expected = [
+                str(operator) for operator in full.operators
+                if inverse_mass_order(operator.tensors,
+                                      frozenset(["MXi"])) <= max_order]
+            self.assertEqual(list(map(str, truncated.operators)), expected)
+
+
+
+class TestSolveEoms(unittest.TestCase):
+    def test_dependency_groups(self):
+        self.assertEqual(eoms_dependency_groups(eoms), [["B", "C"], ["A"]])
+
+    def test_solutions(self):
+        solutions = solve_eoms(eoms, 6)
+        for name in eoms:
+            self.assertFalse(any(solutions[name].contains(other)
+                                 for other in eoms))
+            recursive = eoms[name].replace_all(eoms, 6)
+            self.assertEqual(
+                sum_numbers(solutions[name] + (-recursive)), [])
+
+    def test_previous(self):
+        solutions = solve_eoms(eoms, 6)
+        new_eoms = dict(eoms, A=OpSum(Op(d(), B(), phi())))
+        new_solutions = solve_eoms(new_eoms, 6, previous=solutions,
+                                   changed=["A"])
+        self.assertIs(new_solutions["B"], solutions["B"])
+        self.assertIs(new_solutions["C"], solutions["C"])
+        self.assertEqual(
+            sum_numbers(new_solutions["A"] +
+                        (-new_eoms["A"].replace_all(new_eoms, 6))), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+
+from matchingtools.core import (
+    TensorBuilder, FieldBuilder, Op, OpSum, D, D_op, Pattern,
+    number_op, tensor_op, boson, kdelta)
+from matchingtools.transformations import (
+    apply_rules, compile_rule, compile_rules, integrate_by_parts,
+    sum_numbers)
+
+c = TensorBuilder("c")
+sigma = TensorBuilder("sigma")
+phi = FieldBuilder("phi", 1, boson)
+phic = FieldBuilder("phic", 1, boson)
+
+
+class TestIntegrateByParts(unittest.TestCase):
+    def test_total_derivative(self):
+        total_derivative = (D_op(0, phic(1), phi(1), phic(2), phi(2)) *
+                            OpSum(Op(c(0))))
+        result = integrate_by_parts(total_derivative, verbose=False)
+        self.assertEqual(result.operators, [])
+
+    def test_box(self):
+        box = OpSum(Op(phic(0), D(1, D(1, phi(0)))))
+        result = sum_numbers(integrate_by_parts(box, verbose=False))
+        self.assertEqual(len(result), 1)
+        op, num = result[0]
+        self.assertEqual(op, Op(D(1, phic(0)), D(1, phi(0))))
+        self.assertEqual(num, -1)
+
+
+
+class TestCompileRule(unittest.TestCase):
+    def test_cached(self):
+        pattern = Op(phic(0), phi(0))
+        replacement = OpSum(tensor_op("Ophi2"))
+        rule = compile_rule(pattern, replacement)
+        self.assertIs(compile_rule(pattern, replacement), rule)
+        self.assertIs(compile_rules([rule])[0], rule)
+
+    def test_compiled_pattern(self):
+        pattern = Pattern(Op(phic(0), phi(0)))
+        replacement = OpSum(tensor_op("Ophi2"))
+        rule = compile_rule(pattern, replacement)
+        self.assertIs(rule.pattern, pattern)
+        self.assertIs(compile_rule(pattern, replacement), rule)
+
+
+class TestApplyRules(unittest.TestCase):
+    def test_workers(self):
+        op_sum = OpSum(
+            Op(sigma(0, 1, 2), sigma(0, 3, 4),
+               phic(1), phi(2), phic(3), phi(4)),
+            Op(c(), phic(0), phi(0)),
+            number_op(2) * Op(sigma(0, 1, 2), sigma(0, 3, 4),
+                              D(5, phic(1)), phi(2), phic(3), D(5, phi(4))),
+            Op(c(), phic(0), phi(0), phic(1), phi(1)))
+        fierz_rule = (
+            Op(sigma(0, -1, -2), sigma(0, -3, -4)),
+            OpSum(number_op(2) * Op(kdelta(-1, -4), kdelta(-3, -2)),
+                  -Op(kdelta(-1, -2), kdelta(-3, -4))))
+        definition_rule = (Op(phic(0), phi(0), phic(1), phi(1)),
+                           OpSum(tensor_op("Ophi4")))
+        rules = [fierz_rule, definition_rule]
+        serial = apply_rules(op_sum, rules, 3, verbose=False)
+        parallel = apply_rules(op_sum, rules, 3, verbose=False, workers=2)
+        self.assertEqual(list(map(str, parallel.operators)),
+                         list(map(str, serial.operators)))
+
+
+if __name__ == "__main__":
+    unittest.main()